@@ -3,7 +3,7 @@ import pprint
 
 import django.utils.log
 from celery import Celery
-from celery.signals import task_failure
+from celery.signals import task_failure, worker_process_init, worker_process_shutdown
 
 app = Celery('api', include='desecapi.mail_backends')
 app.config_from_object('django.conf:settings', namespace='CELERY')
@@ -48,6 +48,18 @@ def task_failure(task_id, exception, args, kwargs, traceback, einfo, **other_kwa
     )
 
 
+@worker_process_init.connect()
+def clear_dead_process_metrics(**kwargs):
+    from desecapi import metrics
+    metrics.mark_dead_processes()  # e.g. the worker process this one replaces, if it was killed
+
+
+@worker_process_shutdown.connect()
+def clear_process_metrics(**kwargs):
+    from desecapi import metrics
+    metrics.mark_process_dead()
+
+
 django.setup()
 logger = logging.getLogger(__name__)
 handler = django.utils.log.AdminEmailHandler()
@@ -54,6 +54,7 @@ MIDDLEWARE = (
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
+    'desecapi.middleware.PDNSRequestStatsMiddleware',
     'django_prometheus.middleware.PrometheusAfterMiddleware',
 )
 
@@ -161,6 +162,12 @@ DEFAULT_NS_TTL = os.environ['DESECSTACK_NSLORD_DEFAULT_TTL']
 # Public Suffix settings
 PSL_RESOLVER = os.environ.get('DESECSTACK_API_PSL_RESOLVER')
 LOCAL_PUBLIC_SUFFIXES = {'dedyn.%s' % os.environ['DESECSTACK_DOMAIN']}
+# If set, public suffixes are looked up in this local copy of the PSL instead of querying PSL_RESOLVER. It is
+# downloaded by `manage.py update-psl-snapshot` (run by cron), and reloaded by the workers when it is replaced.
+PSL_SNAPSHOT_PATH = os.environ.get('DESECSTACK_API_PSL_SNAPSHOT_PATH') or None
+PSL_SNAPSHOT_URL = 'https://publicsuffix.org/list/public_suffix_list.dat'
+# Public suffix lookup results are cached for this many seconds
+PSL_CACHE_TIMEOUT = 3600
 
 # PowerDNS-related
 NSLORD_PDNS_API = 'http://nslord:8081/api/v1/servers/localhost'
@@ -180,10 +187,14 @@ TASK_CONFIG = {  # The first entry is the default queue
     'email_immediate_lane': {'rate_limit': None},
 }
 CELERY_TIMEZONE = 'UTC'  # timezone for task schedule below
+# Signatures are rotated weekly by replicating each zone. Zones are spread over this many seconds from Thursday, 00:00
+# UTC on (see desecapi.replication.rotate), and queued in batches in the given interval (in seconds).
+REPLICATION_ROTATION_WINDOW = 24 * 3600
+REPLICATION_ROTATION_INTERVAL = 600
 CELERY_BEAT_SCHEDULE = {
     'rotate_signatures': {
-        'task': 'desecapi.replication.update_all',
-        'schedule': crontab(minute=0, hour=0, day_of_week='thursday'),
+        'task': 'desecapi.replication.rotate',
+        'schedule': REPLICATION_ROTATION_INTERVAL,
         'options': {'priority': 5},  # priority must be higher than rotation jobs for individual domains
     },
     'remove_history': {
@@ -203,10 +214,76 @@ CELERY_TASK_QUEUES = [
 ]
 CELERY_BEAT_MAX_LOOP_INTERVAL = 15  # Low value important for running e2e2 tests in reasonable time
 
+# Zone replication starts right away, but not earlier than this many seconds after the previous run of the same zone,
+# so that further changes are included in the same run. A pending run is assumed to be lost after the timeout (e.g.
+# when the broker was reset), and another one is queued (replicating a zone twice is harmless).
+REPLICATION_DEBOUNCE = 1
+REPLICATION_PENDING_TIMEOUT = 60
+
+# Replicated zones are committed to the zones repository together, once per window (in seconds), or as soon as this
+# many zones are pending.
+REPLICATION_COMMIT_WINDOW = 10
+REPLICATION_COMMIT_MAX_ZONES = 1000
+
+# Git backend used for committing replicated zones: 'subprocess' runs /usr/bin/git for each step, 'fast-import' keeps a
+# `git fast-import` process per worker. The latter does not maintain the index; run `git reset` when switching back.
+ZONE_REPOSITORY_GIT_BACKEND = 'subprocess'
+
+# With the 'fast-import' backend, each commit writes a pack; packs are merged after this many commits per worker.
+ZONE_REPOSITORY_REPACK_CHECKPOINTS = 100
+
+# Unreachable objects in the zone repository are deleted when they are older than this (in seconds). This must exceed
+# the duration of history removal, which runs concurrently with commits.
+ZONE_REPOSITORY_PRUNE_GRACE = 3600
+
+# Layout of new zone repositories: 'flat' (<zone>.zone) or 'hash' (<first two hex digits of the zone's SHA-256 hash>/
+# <zone>.zone). Existing repositories keep their layout; use `manage.py migrate-zone-repository` to change it.
+ZONE_REPOSITORY_LAYOUT = 'flat'
+
+# Number of zones pending replication for which the desecapi_replication_lag metric is exported (most lagging first)
+METRICS_REPLICATION_LAG_ZONES = 100
+
+# Replication backlog metrics are computed from the database at most once in this many seconds
+METRICS_REPLICATION_CACHE_TIMEOUT = 60
+
 # pdns accepts request payloads of this size.
 # This will hopefully soon be configurable: https://github.com/PowerDNS/pdns/pull/7550
 PDNS_MAX_BODY_SIZE = 16 * 1024 * 1024
 
+# pdns API connection handling (connections are kept alive per process and server)
+PDNS_TIMEOUT = (5, 120)  # (connect, read) in seconds; large PATCH requests can take a while
+PDNS_CONCURRENCY = 1  # max. number of zones for which a change tracker talks to pdns in parallel (1: sequential)
+PDNS_POOL_SIZE = max(10, PDNS_CONCURRENCY)
+PDNS_RETRIES = 3  # only for idempotent requests (GET, PUT axfr-retrieve) and connection failures
+PDNS_RETRY_BACKOFF_FACTOR = .5
+
+# Write-behind mode: RRset changes are recorded in an outbox when committed, and sent to pdns later by the
+# flush-pdns-outbox command, merging all changes of a zone that were made within the given window (in seconds)
+PDNS_WRITE_BEHIND = False
+PDNS_WRITE_BEHIND_WINDOW = 2
+
+# Without write-behind, the outbox only holds updates to be retried (see PDNSChangeTracker._reconcile()), and is checked
+# this often (in seconds)
+PDNS_OUTBOX_RETRY_INTERVAL = 60
+
+# Canonical presentation format of records is cached (per process) for this many (record, type) pairs, if the record
+# is no longer than the given length (to bound memory usage)
+RR_CANONICAL_FORMAT_CACHE_SIZE = 10000
+RR_CANONICAL_FORMAT_CACHE_MAX_LENGTH = 256
+
+# DNSSEC key information is cached, and invalidated when keys change (zone creation/deletion, rollover)
+PDNS_KEYS_CACHE_TIMEOUT = 24 * 3600
+
+# Zone transfer triggers (axfr-retrieve) are remembered for this many seconds, to skip redundant ones
+PDNS_AXFR_CACHE_TIMEOUT = 60
+
+# Delta serial feed (/serials?since=<cursor>): changes are reported again until nsmaster had time to pick them up, and
+# are kept for the given retention period. Serials of changed zones are looked up individually on nsmaster (unless the
+# full list is cached); deltas needing more lookups are refused, so that the client retrieves the full list instead.
+SERIALS_CHANGE_SETTLE_PERIOD = timedelta(seconds=30)
+SERIALS_CHANGE_RETENTION = timedelta(days=1)
+SERIALS_DELTA_LOOKUP_LIMIT = 100
+
 # SEPA direct debit settings
 SEPA = {
     'CREDITOR_ID': os.environ['DESECSTACK_API_SEPA_CREDITOR_ID'],
@@ -239,7 +316,14 @@ WATCHDOG_WINDOW_SEC = 600
 try:
     import uwsgi
 except ImportError:
-    pass  # not running in uwsgi, e.g. management command
+    if 'prometheus_multiproc_dir' in os.environ:
+        # Celery worker sharing the metrics directory with the API (see docker-compose.yml); make sure that metric file
+        # names differ from those of uwsgi workers and of other containers (see desecapi.metrics.mark_dead_processes)
+        import prometheus_client
+        import socket
+        METRICS_PROCESS_PREFIX = f'celery-{socket.gethostname()}-'
+        prometheus_client.values.ValueClass = prometheus_client.values.MultiProcessValue(
+            process_identifier=lambda: f'{METRICS_PROCESS_PREFIX}{os.getpid()}')
 else:
     import prometheus_client
     prometheus_client.values.ValueClass = prometheus_client.values.MultiProcessValue(
@@ -1,5 +1,7 @@
 from django.urls import include, path
 
+from desecapi import metrics
+
 
 #
 # On Reversing URLs
@@ -58,6 +60,6 @@ urlpatterns = [
     path('api/v2/', include('desecapi.urls.version_2', namespace='v2')),
     # the DEFAULT version
     path('api/v1/', include('desecapi.urls.version_1', namespace='v1')),
-    # monitoring
-    path('', include('django_prometheus.urls')),
+    # monitoring (like django_prometheus.urls, plus metrics collected at scrape time)
+    path('metrics', metrics.export, name='prometheus-django-metrics'),
 ]
@@ -14,3 +14,16 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api.settings")
 from django.core.wsgi import get_wsgi_application
 
 application = get_wsgi_application()
+
+try:
+    import uwsgi
+    from uwsgidecorators import postfork
+except ImportError:
+    pass
+else:
+    from desecapi.metrics import mark_process_dead
+
+    # Values of live gauges (e.g. pdns requests in progress) must not outlive the worker. Worker IDs are reused when a
+    # worker is respawned (e.g. after it was killed), so the new worker also removes what its predecessor left behind.
+    postfork(lambda: mark_process_dead(uwsgi.worker_id()))
+    uwsgi.atexit = lambda: mark_process_dead(uwsgi.worker_id())
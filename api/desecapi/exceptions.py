@@ -15,6 +15,17 @@ class PDNSException(APIException):
         return super().__init__(detail)
 
 
+class PDNSPartialUpdateException(PDNSException):
+    """
+    Raised when a zone update had to be split into several requests, and some (but not all) of them were applied.
+    """
+    def __init__(self, response=None, applied=0, total=0):
+        self.applied = applied
+        self.total = total
+        super().__init__(response)
+        self.detail = f'{self.detail} (applied {applied} of {total} RRsets before failure)'
+
+
 class ConcurrencyException(APIException):
     status_code = status.HTTP_429_TOO_MANY_REQUESTS
     default_detail = 'Too many concurrent requests.'
@@ -0,0 +1,61 @@
+import contextlib
+import io
+import os
+import random
+import time
+from tempfile import TemporaryDirectory
+
+from django.core.management import BaseCommand
+
+from desecapi.replication import GIT_BACKENDS, Repository
+
+
+class Command(BaseCommand):
+    help = 'Compare git backends for committing zone updates (see settings.ZONE_REPOSITORY_GIT_BACKEND).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--zones', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                            help='Number of zone files in the repository (one run per value).')
+        parser.add_argument('--changed', type=int, default=100, help='Number of zone files changed per commit.')
+        parser.add_argument('--rounds', type=int, default=10, help='Number of commits per backend.')
+        parser.add_argument('--path', help='Create repositories below this directory (default: system temp dir).')
+
+    @staticmethod
+    def write(path, name, serial):
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(f'@ 300 IN SOA ns1.example. admin.example. {serial} 1 1 1 1\n'
+                    f'@ 300 IN A 192.0.2.{serial % 256}\n')
+
+    def handle(self, *args, **options):
+        for zones in options['zones']:
+            with TemporaryDirectory(dir=options['path']) as path:
+                self.stdout.write(f'Creating repository with {zones} zone files ...')
+                names = [f'zone{i}.example.zone' for i in range(zones)]
+                for name in names:
+                    self.write(path, name, 1)
+                repo = Repository(path)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    repo.init()
+                    repo.commit_all('Inception')
+
+                serial = 1
+                for key, backend in GIT_BACKENDS.items():
+                    repo = Repository(path, backend)
+                    durations = []
+                    for _ in range(options['rounds']):
+                        serial += 1
+                        paths = random.sample(names, min(options['changed'], zones))
+                        for name in paths:
+                            self.write(path, name, serial)
+                        t = time.perf_counter()
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            repo.commit(paths, f'Update for {len(paths)} zones')
+                        durations.append(time.perf_counter() - t)
+                    repo.backend.close()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        repo._git_do('reset', '-q')  # the fast-import backend does not maintain the index
+
+                    durations.sort()
+                    self.stdout.write(f'{zones} zones, {key}: '
+                                      f'median {durations[len(durations) // 2] * 1000:.1f}ms, '
+                                      f'max {durations[-1] * 1000:.1f}ms per commit of {len(paths)} changed zones')
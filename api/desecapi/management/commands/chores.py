@@ -24,6 +24,10 @@ class Command(BaseCommand):
         models.User.objects.filter(is_active=False, last_login__exact=None,
                             created__lt=timezone.now() - settings.VALIDITY_PERIOD_VERIFICATION_SIGNATURE).delete()
 
+    @staticmethod
+    def delete_expired_zone_changes():
+        models.ZoneChange.objects.filter(created__lt=timezone.now() - settings.SERIALS_CHANGE_RETENTION).delete()
+
     @staticmethod
     def update_healthcheck_timestamp():
         name = 'internal-timestamp.desec.test'
@@ -90,6 +94,7 @@ class Command(BaseCommand):
             self.update_healthcheck_timestamp()
             self.delete_expired_captchas()
             self.delete_never_activated_users()
+            self.delete_expired_zone_changes()
         except Exception as e:
             subject = 'chores Exception!'
             message = f'{type(e)}\n\n{str(e)}'
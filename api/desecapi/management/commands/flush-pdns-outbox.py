@@ -0,0 +1,45 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db.models import Min
+from django.utils import timezone
+
+from desecapi import metrics
+from desecapi.models import RRsetOutbox
+from desecapi.pdns_change_tracker import PDNSChangeTracker
+
+
+class Command(BaseCommand):
+    help = 'Send RRset changes from the write-behind outbox to pdns (see settings.PDNS_WRITE_BEHIND).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep flushing zones whose oldest change is older than PDNS_WRITE_BEHIND_WINDOW '
+                                 '(runs as the pdns-outbox service). Without write-behind, the outbox is checked only '
+                                 'every PDNS_OUTBOX_RETRY_INTERVAL seconds.')
+
+    def handle(self, *args, **options):
+        metrics.mark_dead_processes()  # e.g. a previous run that was killed while sending requests to pdns
+        while True:
+            domain_names = RRsetOutbox.objects.values('domain_name').annotate(oldest=Min('created'))
+            if options['loop']:
+                threshold = timezone.now() - timedelta(seconds=settings.PDNS_WRITE_BEHIND_WINDOW)
+                domain_names = domain_names.filter(oldest__lte=threshold)
+
+            for domain_name in domain_names.values_list('domain_name', flat=True):
+                try:
+                    count = PDNSChangeTracker.flush(domain_name)
+                except Exception as e:
+                    # Entries remain in the outbox and will be retried
+                    self.stderr.write(f'{domain_name}: {type(e).__name__} {e}')
+                else:
+                    self.stdout.write(f'{domain_name}: flushed {count} change(s)')
+
+            if not options['loop']:
+                break
+            if settings.PDNS_WRITE_BEHIND:
+                time.sleep(settings.PDNS_WRITE_BEHIND_WINDOW / 2)
+            else:
+                time.sleep(settings.PDNS_OUTBOX_RETRY_INTERVAL)
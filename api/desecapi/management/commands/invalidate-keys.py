@@ -0,0 +1,28 @@
+from django.core.management import BaseCommand, CommandError
+
+from desecapi import pdns
+from desecapi.models import Domain
+
+
+class Command(BaseCommand):
+    help = 'Remove cached DNSSEC key information (e.g. after a key rollover on nslord).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('domain-name', nargs='*',
+                            help='Domain name whose keys changed. If omitted, will invalidate keys of all API domains.')
+
+    def handle(self, *args, **options):
+        domain_names = Domain.objects.values_list('name', flat=True)
+
+        if options['domain-name']:
+            domain_names = domain_names.filter(name__in=options['domain-name'])
+
+            for domain_name in options['domain-name']:
+                if domain_name not in domain_names:
+                    raise CommandError('{} is not a known domain'.format(domain_name))
+
+        count = 0
+        for domain_name in domain_names:
+            pdns.invalidate_keys(domain_name)
+            count += 1
+        self.stdout.write(f'Invalidated cached keys of {count} domain(s).')
@@ -0,0 +1,20 @@
+from django.core.management import BaseCommand
+
+from desecapi.replication import ZONE_REPOSITORY_PATH, ZoneRepository
+
+
+class Command(BaseCommand):
+    help = 'Move the zone files of the zone repository to another directory layout. Stop replication workers first.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('layout', choices=ZoneRepository.LAYOUTS.keys(),
+                            help='Target layout (see settings.ZONE_REPOSITORY_LAYOUT).')
+        parser.add_argument('--path', default=ZONE_REPOSITORY_PATH, help='Path of the zone repository.')
+
+    def handle(self, *args, **options):
+        repo = ZoneRepository(options['path'])
+        if repo.layout == options['layout']:
+            self.stdout.write(f'Zone repository already uses the {repo.layout} layout.')
+            return
+        moved = repo.migrate_layout(options['layout'])
+        self.stdout.write(f'Moved {moved} zone files to the {options["layout"]} layout.')
@@ -65,7 +65,9 @@ class Command(BaseCommand):
         deletions.discard(('SOA', ''))  # do not remove SOA record
 
         # Update zone on nslord, propagate to nsmaster
-        PDNSChangeTracker.CreateUpdateDeleteRRSets(domain.name, set(), modifications, deletions).pdns_do()
+        change = PDNSChangeTracker.CreateUpdateDeleteRRSets(domain.name, set(), modifications, deletions)
+        change.pdns_prepare()
+        change.pdns_do()
         pdns._pdns_put(pdns.NSMASTER, '/zones/{}/axfr-retrieve'.format(pdns.pdns_id(domain.name)))
 
         return created
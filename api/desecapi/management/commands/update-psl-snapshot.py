@@ -0,0 +1,40 @@
+import os
+import tempfile
+
+import requests
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from desecapi.psl import Snapshot
+
+
+class Command(BaseCommand):
+    help = 'Download the Public Suffix List to settings.PSL_SNAPSHOT_PATH (no-op if not set).'
+
+    def handle(self, *args, **options):
+        path = settings.PSL_SNAPSHOT_PATH
+        if not path:
+            return
+
+        response = requests.get(settings.PSL_SNAPSHOT_URL, timeout=30)
+        response.raise_for_status()
+        content = response.content
+        # Refuse to replace the snapshot with something that is obviously not the PSL (e.g. a truncated download)
+        if b'===END ICANN DOMAINS===' not in content or len(Snapshot(content.decode().splitlines()).rules) < 1000:
+            raise CommandError(f'Unexpected content at {settings.PSL_SNAPSHOT_URL}')
+
+        try:
+            with open(path, 'rb') as f:
+                if f.read() == content:
+                    return
+        except FileNotFoundError:
+            pass
+
+        # Replace atomically, so that workers never read a partial file
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+            f.write(content)
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path)
+        self.stdout.write(f'Updated {path}')
@@ -1,4 +1,15 @@
-from prometheus_client import Counter, Histogram, Summary
+import glob
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Min, Q
+from django.http import HttpResponse
+from django.utils import timezone
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, Summary, generate_latest, multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
 
 metrics = {}
 
@@ -11,6 +22,10 @@ def set_counter(name, *args, **kwargs):
     metrics[name] = Counter(name, *args, **kwargs)
 
 
+def set_gauge(name, *args, **kwargs):
+    metrics[name] = Gauge(name, *args, **kwargs)
+
+
 def set_histogram(name, *args, **kwargs):
     metrics[name] = Histogram(name, *args, **kwargs)
 
@@ -23,9 +38,24 @@ def set_summary(name, *args, **kwargs):
 set_counter('desecapi_captcha_content_created', 'number of times captcha content created', ['kind'])
 set_counter('desecapi_autodelegation_created', 'number of autodelegations added')
 set_counter('desecapi_autodelegation_deleted', 'number of autodelegations deleted')
+set_counter('desecapi_rr_canonical_format_calls', 'number of records converted to canonical presentation format')
+set_histogram('desecapi_rr_canonical_format_parse_duration',
+              'duration of record parsing for canonical presentation format in seconds (calls minus count: cache hits)',
+              buckets=[.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .005, .01, float("inf")])
 set_histogram('desecapi_messages_queued', 'number of emails queued', ['reason', 'user', 'lane'],
               buckets=[0, 1, float("inf")])
 
+set_counter('desecapi_psl_resolver_fallback', 'number of times the TLD was assumed as public suffix (PSL unavailable)')
+
+# psl.py metrics
+set_counter('desecapi_psl_cache_hit', 'number of times a public suffix was found in cache')
+set_counter('desecapi_psl_cache_miss', 'number of times a public suffix was not found in cache')
+set_counter('desecapi_psl_lookups', 'number of public suffix lookups on cache miss', ['source'])
+
+# middleware.py metrics
+set_summary('desecapi_view_pdns_requests', 'number of pdns requests made per API request', ['view'])
+set_summary('desecapi_view_pdns_duration', 'time spent on pdns requests per API request in seconds', ['view'])
+
 # views.py metrics
 set_counter('desecapi_dynDNS12_domain_not_found', 'number of times dynDNS12 domain is not found')
 
@@ -38,10 +68,134 @@ set_counter('desecapi_database_unavailable', 'number of times database was unava
 
 # pdns.py metrics
 set_counter('desecapi_pdns_request_success', 'number of times pdns request was successful', ['method', 'status'])
+set_counter('desecapi_pdns_request_failure', 'number of times pdns request failed (status "error": no response)',
+            ['server', 'method', 'endpoint', 'status'])
+set_histogram('desecapi_pdns_request_duration', 'duration of pdns requests in seconds', ['server', 'method', 'endpoint'],
+              buckets=[.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, float("inf")])
+set_gauge('desecapi_pdns_requests_in_progress', 'number of pdns requests in progress', ['server'],
+          multiprocess_mode='livesum')
 set_counter('desecapi_pdns_keys_fetched', 'number of times pdns keys were fetched')
+set_counter('desecapi_pdns_keys_cache_hit', 'number of times pdns keys were found in cache')
+set_counter('desecapi_pdns_keys_cache_miss', 'number of times pdns keys were not found in cache')
+set_counter('desecapi_pdns_pool_connections', 'number of connections opened by pdns connection pool', ['server'])
+set_counter('desecapi_pdns_pool_requests', 'number of requests sent through pdns connection pool', ['server'])
 
 # pdns_change_tracker.py metrics
 set_counter('desecapi_pdns_catalog_updated', 'number of times pdns catalog was updated successfully')
+set_counter('desecapi_pdns_axfr_coalesced', 'number of axfr-retrieve triggers skipped as one was sent meanwhile')
+set_counter('desecapi_pdns_reconciliations', 'number of partially applied zone updates whose database state was sent '
+                                             'to pdns again', ['result'])
+
+# replication.py metrics
+set_counter('desecapi_replication_transfers', 'number of zone transfers for replication', ['kind'])
+set_counter('desecapi_replication_transfer_records', 'number of records received in zone transfers', ['kind'])
+set_counter('desecapi_replication_coalesced', 'number of replication triggers merged into a pending replication')
+set_histogram('desecapi_replication_stage_duration', 'duration of replication stages in seconds', ['stage'],
+              buckets=[.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, float("inf")])
+set_counter('desecapi_replication_written_bytes', 'number of bytes written to zone files')
+set_counter('desecapi_replication_rotation_queued', 'number of zones queued for signature rotation')
+set_counter('desecapi_replication_rotation_skipped', 'number of signature rotations skipped as the zone was replicated')
+set_counter('desecapi_replication_unchanged', 'number of replications without change to the zone file (not committed)')
+set_histogram('desecapi_replication_delay', 'time from publication of a zone until its replication in seconds',
+              buckets=[1, 5, 10, 15, 30, 60, 120, 300, 600, 1800, 3600, float("inf")])
+set_histogram('desecapi_replication_prune_duration', 'duration of zone repository history removal in seconds',
+              buckets=[1, 5, 10, 30, 60, 120, 300, 600, 1800, float("inf")])
+set_counter('desecapi_replication_prune_reclaimed_bytes', 'number of bytes reclaimed by history removal')
 
 # throttling.py metrics
 set_counter('desecapi_throttle_failure', 'number of requests throttled', ['method', 'scope', 'user', 'bucket'])
+
+
+class ReplicationCollector:
+    """
+    Collects the replication backlog from the database at scrape time: zones published, but not replicated since,
+    and the progress of signature rotation. The database is queried at most once per
+    settings.METRICS_REPLICATION_CACHE_TIMEOUT seconds (across processes and scrapers).
+    """
+    CACHE_KEY = 'desecapi.metrics.replication'
+
+    @staticmethod
+    def get_stats():
+        from desecapi.models import Domain  # models.py imports this module
+        from desecapi.replication import rotation_cycle_start  # replication.py imports this module
+
+        pending = Domain.objects.filter(Q(replicated__isnull=True) | Q(replicated__lt=F('published')),
+                                        published__isnull=False)
+        stats = pending.aggregate(pending=Count('pk'), oldest=Min('published'))
+        lagging = pending.order_by('published').values_list('name', 'published')
+        stats['lagging'] = list(lagging[:settings.METRICS_REPLICATION_LAG_ZONES])
+        stats.update(Domain.objects.aggregate(
+            total=Count('pk'), rotated=Count('pk', filter=Q(replicated__gte=rotation_cycle_start(timezone.now())))
+        ))
+        return stats
+
+    def collect(self):
+        stats = cache.get(self.CACHE_KEY)
+        if stats is None:
+            stats = self.get_stats()
+            cache.set(self.CACHE_KEY, stats, timeout=settings.METRICS_REPLICATION_CACHE_TIMEOUT)
+
+        now = timezone.now()
+        yield GaugeMetricFamily('desecapi_replication_pending', 'number of zones pending replication',
+                                value=stats['pending'])
+        yield GaugeMetricFamily('desecapi_replication_pending_age',
+                                'seconds since publication of the oldest zone pending replication',
+                                value=(now - stats['oldest']).total_seconds() if stats['oldest'] else 0)
+        lag = GaugeMetricFamily('desecapi_replication_lag',
+                                'seconds since publication of zones pending replication (the most lagging ones only)',
+                                labels=['zone'])
+        for name, published in stats['lagging']:
+            lag.add_metric([name], (now - published).total_seconds())
+        yield lag
+
+        yield GaugeMetricFamily('desecapi_replication_rotation_progress',
+                                'fraction of zones replicated since the start of the signature rotation cycle',
+                                value=stats['rotated'] / stats['total'] if stats['total'] else 1)
+
+
+scrape_time_registry = CollectorRegistry()
+scrape_time_registry.register(ReplicationCollector())
+
+
+def mark_process_dead(identifier=None):
+    """
+    Removes the values of live gauges (multiprocess_mode='livesum') of the given process, so that they no longer count
+    once the process is gone. The identifier defaults to the one of the current (non-uwsgi) process.
+    """
+    if 'prometheus_multiproc_dir' not in os.environ:
+        return
+    if identifier is None:
+        identifier = f'{settings.METRICS_PROCESS_PREFIX}{os.getpid()}'
+    multiprocess.mark_process_dead(identifier)
+
+
+def mark_dead_processes():
+    """
+    Calls mark_process_dead() for the processes of this container (see settings.METRICS_PROCESS_PREFIX) which no longer
+    exist, e.g. because they were killed before they could clean up.
+    """
+    if 'prometheus_multiproc_dir' not in os.environ or not hasattr(settings, 'METRICS_PROCESS_PREFIX'):
+        return
+    prefix = settings.METRICS_PROCESS_PREFIX
+    for path in glob.glob(os.path.join(os.environ['prometheus_multiproc_dir'], f'gauge_live*_{prefix}*.db')):
+        pid = os.path.basename(path)[:-len('.db')].rsplit('_', 1)[1][len(prefix):]
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            mark_process_dead(prefix + pid)
+        except (ValueError, PermissionError):  # not a PID, or the process exists (with another user)
+            pass
+
+
+def export(request):
+    """
+    Exports metrics like django_prometheus' ExportToDjangoView, including those collected at scrape time. (In
+    multiprocess mode, only metrics from the shared metrics directory would be exported otherwise.)
+    """
+    if 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry) + generate_latest(scrape_time_registry),
+                        content_type=CONTENT_TYPE_LATEST)
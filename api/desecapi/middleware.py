@@ -0,0 +1,20 @@
+from desecapi import metrics
+from desecapi.pdns import track_request_stats
+
+
+class PDNSRequestStatsMiddleware:
+    """
+    Records how many pdns requests each API request made, and how much time they took, labelled by view.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with track_request_stats() as stats:
+            response = self.get_response(request)
+        if request.resolver_match is not None:
+            view = request.resolver_match.view_name
+            metrics.get('desecapi_view_pdns_requests').labels(view).observe(stats.count)
+            metrics.get('desecapi_view_pdns_duration').labels(view).observe(stats.duration)
+        return response
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-17 07:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('desecapi', '0018_zonechange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RRsetOutbox',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('domain_name', models.CharField(db_index=True, max_length=191)),
+                ('subname', models.CharField(blank=True, max_length=178)),
+                ('type', models.CharField(max_length=10)),
+            ],
+        ),
+    ]
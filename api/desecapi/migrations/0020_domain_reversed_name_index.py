@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-17 08:43
+
+from django.db import migrations, models
+import django.db.models.functions.comparison
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('desecapi', '0019_rrsetoutbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='domain',
+            index=models.Index(django.db.models.functions.comparison.Collate(django.db.models.functions.text.Reverse('name'), 'C'), name='desecapi_domain_reversed_name'),
+        ),
+    ]
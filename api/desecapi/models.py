@@ -10,7 +10,7 @@ import string
 import time
 import uuid
 from datetime import timedelta
-from functools import cached_property
+from functools import cached_property, lru_cache
 from hashlib import sha256
 
 import dns
@@ -25,9 +25,9 @@ from django.core.exceptions import ValidationError
 from django.core.mail import EmailMessage, get_connection
 from django.core.validators import MinValueValidator, RegexValidator
 from django.db import models
-from django.db.models import CharField, F, Manager, Q, Value
+from django.db.models import Manager, Q
 from django.db.models.expressions import RawSQL
-from django.db.models.functions import Concat, Length
+from django.db.models.functions import Collate, Length, Reverse
 from django.template.loader import get_template
 from django.utils import timezone
 from django_prometheus.models import ExportModelOperationsMixin
@@ -41,9 +41,10 @@ from rest_framework.exceptions import APIException
 from desecapi import metrics
 from desecapi import pdns
 from desecapi.dns import AAAA, CDS, DLV, DS, LongQuotedTXT, MX, NS, SRV
+from desecapi.psl import PSL
 
 logger = logging.getLogger(__name__)
-psl = psl_dns.PSL(resolver=settings.PSL_RESOLVER, timeout=.5)
+psl = PSL(resolver=settings.PSL_RESOLVER, timeout=.5)
 
 
 def validate_lower(value):
@@ -211,11 +212,10 @@ class DomainManager(Manager):
             Domain._meta.get_field('name').run_validators(qname.removeprefix('*.'))
         except ValidationError:
             raise ValueError
-        return self.annotate(
-            dotted_name=Concat(Value('.'), 'name', output_field=CharField()),
-            dotted_qname=Value(f'.{qname}', output_field=CharField()),
-            name_length=Length('name'),
-        ).filter(dotted_qname__endswith=F('dotted_name'), **kwargs)
+        # The domain name is one of the qname's ancestors (or the qname itself); look them up through the unique index
+        labels = qname.split('.')
+        ancestors = ['.'.join(labels[i:]) for i in range(len(labels))]
+        return self.annotate(name_length=Length('name')).filter(name__in=ancestors, **kwargs)
 
 
 class Domain(ExportModelOperationsMixin('Domain'), models.Model):
@@ -258,6 +258,7 @@ class Domain(ExportModelOperationsMixin('Domain'), models.Model):
             public_suffix = psl.get_public_suffix(self.name)
             is_public_suffix = psl.is_public_suffix(self.name)
         except (Timeout, NoNameservers):
+            metrics.get('desecapi_psl_resolver_fallback').inc()
             public_suffix = self.name.rpartition('.')[2]
             is_public_suffix = ('.' not in self.name)  # TLDs are public suffixes
         except psl_dns.exceptions.UnsupportedRule as e:
@@ -297,7 +298,10 @@ class Domain(ExportModelOperationsMixin('Domain'), models.Model):
         # Note: This is not completely accurate: Ideally, we should only consider zones with identical public suffix.
         # (If a public suffix lies in between, it's ok.) However, as there could be many descendant zones, the accurate
         # check is expensive, so currently not implemented (PSL lookups for each of them).
-        return Domain.objects.filter(Q(name__endswith=f'.{self.name}') & ~Q(owner=self._owner_or_none)).exists()
+        # Descendants are found by a prefix match on the reversed name, which is served by an index (see Meta).
+        return Domain.objects.annotate(reversed_name=Collate(Reverse('name'), 'C')).filter(
+            Q(reversed_name__startswith=f'.{self.name}'[::-1]) & ~Q(owner=self._owner_or_none)
+        ).exists()
 
     def is_registrable(self):
         """
@@ -405,6 +409,10 @@ class Domain(ExportModelOperationsMixin('Domain'), models.Model):
 
     class Meta:
         ordering = ('created',)
+        indexes = [
+            # byte-wise collation so that PostgreSQL can use the index for LIKE 'prefix%'
+            models.Index(Collate(Reverse('name'), 'C'), name='desecapi_domain_reversed_name'),
+        ]
 
 
 class Token(ExportModelOperationsMixin('Token'), rest_framework.authtoken.models.Token):
@@ -587,7 +595,7 @@ class RRset(ExportModelOperationsMixin('RRset'), models.Model):
         self.full_clean(validate_unique=False)
         super().save(*args, **kwargs)
 
-    def clean_records(self, records_presentation_format):
+    def clean_records(self, records_presentation_format, canonical=False):
         """
         Validates the records belonging to this set. Validation rules follow the DNS specification; some types may
         incur additional validation rules.
@@ -597,6 +605,8 @@ class RRset(ExportModelOperationsMixin('RRset'), models.Model):
         Returns a set of records in canonical presentation format.
 
         :param records_presentation_format: iterable of records in presentation format
+        :param canonical: whether the records are known to be in canonical presentation format already (e.g. as
+            returned by RR.canonical_presentation_format), so that they need not be parsed again
         """
         errors = []
 
@@ -616,7 +626,7 @@ class RRset(ExportModelOperationsMixin('RRset'), models.Model):
         records_canonical_format = set()
         for r in records_presentation_format:
             try:
-                r_canonical_format = RR.canonical_presentation_format(r, self.type)
+                r_canonical_format = r if canonical else RR.canonical_presentation_format(r, self.type)
             except ValueError as ex:
                 errors.append(_error_msg(r, str(ex)))
             else:
@@ -631,7 +641,7 @@ class RRset(ExportModelOperationsMixin('RRset'), models.Model):
 
         return records_canonical_format
 
-    def save_records(self, records):
+    def save_records(self, records, canonical=False):
         """
         Updates this RR set's resource records, discarding any old values.
 
@@ -647,8 +657,9 @@ class RRset(ExportModelOperationsMixin('RRset'), models.Model):
         Changes are saved to the database immediately.
 
         :param records: list of records in presentation format
+        :param canonical: whether the records are in canonical presentation format already (see clean_records())
         """
-        new_records = self.clean_records(records)
+        new_records = self.clean_records(records, canonical=canonical)
 
         # Delete RRs that are not in the new record list from the DB
         self.records.exclude(content__in=new_records).delete()  # one DELETE
@@ -701,7 +712,26 @@ class RR(ExportModelOperationsMixin('RR'), models.Model):
         """
         Converts any valid presentation format for a RR into it's canonical presentation format.
         Raises if provided presentation format is invalid.
+
+        Results for short records are cached (see settings.RR_CANONICAL_FORMAT_CACHE_SIZE), as the same contents
+        (e.g. IP addresses from dynDNS updates) are submitted over and over.
         """
+        metrics.get('desecapi_rr_canonical_format_calls').inc()
+        if len(any_presentation_format) > settings.RR_CANONICAL_FORMAT_CACHE_MAX_LENGTH:
+            return RR._canonical_presentation_format(any_presentation_format, type_)
+        return RR._canonical_presentation_format_cached(any_presentation_format, type_)
+
+    @staticmethod
+    def _canonical_presentation_format(any_presentation_format, type_):
+        with metrics.get('desecapi_rr_canonical_format_parse_duration').time():
+            return RR._parse_presentation_format(any_presentation_format, type_)
+
+    # Exceptions are not cached. The cache is per process.
+    _canonical_presentation_format_cached = staticmethod(lru_cache(maxsize=settings.RR_CANONICAL_FORMAT_CACHE_SIZE)(
+        _canonical_presentation_format.__func__))
+
+    @staticmethod
+    def _parse_presentation_format(any_presentation_format, type_):
         rdtype = rdatatype.from_text(type_)
 
         try:
@@ -982,3 +1012,25 @@ class Captcha(ExportModelOperationsMixin('Captcha'), models.Model):
             and
             age <= settings.CAPTCHA_VALIDITY_PERIOD  # not expired
         )
+
+
+class ZoneChange(models.Model):
+    """
+    Change index for the delta serial feed: one entry per zone (and publication) whose serial may have changed on
+    nsmaster. The ID serves as cursor for secondaries.
+    """
+    id = models.BigAutoField(primary_key=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    name = models.CharField(max_length=191)
+
+
+class RRsetOutbox(models.Model):
+    """
+    Outbox for RRset changes that have been committed to the database, but not yet sent to pdns (write-behind mode,
+    see settings.PDNS_WRITE_BEHIND). Only the RRset's identity is stored; its contents are read when flushing.
+    """
+    id = models.BigAutoField(primary_key=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    domain_name = models.CharField(max_length=191, db_index=True)
+    subname = models.CharField(max_length=178, blank=True)
+    type = models.CharField(max_length=10)
@@ -1,10 +1,18 @@
 import json
+import os
 import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 from hashlib import sha1
 
 import requests
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import SuspiciousOperation
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from desecapi import metrics
 from desecapi.exceptions import PDNSException, RequestEntityTooLarge
@@ -25,6 +33,7 @@ NSMASTER = object()
 
 _config = {
     NSLORD: {
+        'name': 'nslord',
         'base_url': settings.NSLORD_PDNS_API,
         'headers': {
             'Accept': 'application/json',
@@ -33,6 +42,7 @@ _config = {
         }
     },
     NSMASTER: {
+        'name': 'nsmaster',
         'base_url': settings.NSMASTER_PDNS_API,
         'headers': {
             'Accept': 'application/json',
@@ -43,15 +53,119 @@ _config = {
 
 }
 
+_sessions = {}
+_sessions_pid = None
+_pool_counts = {}  # connections opened and requests sent per server, as last reported (see _update_pool_metrics())
+_pool_counts_lock = threading.Lock()
+
+_request_stats = ContextVar('desecapi.pdns.request_stats', default=None)
+
+
+class RequestStats:
+    """
+    Number and duration of pdns requests made while tracking (see track_request_stats()).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.
+        self._lock = threading.Lock()  # pdns requests of a change tracker may be made from several threads
+
+    def add(self, duration):
+        with self._lock:
+            self.count += 1
+            self.duration += duration
+
+
+@contextmanager
+def track_request_stats():
+    """
+    Counts the pdns requests made within this context, including those made from threads started with a copy of the
+    context (contextvars.copy_context()).
+    """
+    stats = RequestStats()
+    token = _request_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _request_stats.reset(token)
+
+
+def _endpoint(path):
+    """
+    Returns the endpoint template for the given API path, e.g. zones/{id}/cryptokeys for /zones/example.com./cryptokeys
+    """
+    parts = path.split('?', 1)[0].strip('/').split('/')
+    return '/'.join('{id}' if i > 0 and parts[i - 1] in ('zones', 'cryptokeys', 'metadata') else part
+                    for i, part in enumerate(parts))
+
+
+def _session(server):
+    """
+    Returns the HTTP session for the given server. Sessions keep connections alive in a pool and retry idempotent
+    requests (GET, and PUT which we only use for axfr-retrieve). They are created lazily and per process, so that
+    forked workers (uwsgi, celery) never share sockets with their parent.
+    """
+    global _sessions_pid
+    if _sessions_pid != os.getpid():
+        _sessions.clear()
+        _pool_counts.clear()
+        _sessions_pid = os.getpid()
+
+    if server not in _sessions:
+        retry = Retry(
+            total=settings.PDNS_RETRIES,
+            backoff_factor=settings.PDNS_RETRY_BACKOFF_FACTOR,
+            allowed_methods=frozenset({'GET', 'PUT'}),
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,  # let the caller see the last response
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.PDNS_POOL_SIZE, max_retries=retry)
+        session = requests.Session()
+        session.headers.update(_config[server]['headers'])
+        session.mount(_config[server]['base_url'], adapter)
+        _sessions[server] = session
+
+    return _sessions[server]
+
+
+def _update_pool_metrics(server, session, url):
+    # urllib3 keeps lifetime totals per pool; the counters are advanced by what was added since the last report
+    pool = session.get_adapter(url).poolmanager.connection_from_url(url)
+    counts = pool.num_connections, pool.num_requests
+    with _pool_counts_lock:
+        reported = _pool_counts.get(server, (0, 0))
+        _pool_counts[server] = tuple(map(max, counts, reported))
+    for name, count, previous in zip(['connections', 'requests'], counts, reported):
+        if count > previous:
+            metrics.get(f'desecapi_pdns_pool_{name}').labels(_config[server]['name']).inc(count - previous)
+
 
 def _pdns_request(method, *, server, path, data=None):
-    if data is not None:
+    if data is not None and not isinstance(data, bytes):  # bytes are taken to be JSON-encoded already
         data = json.dumps(data)
     if data is not None and len(data) > settings.PDNS_MAX_BODY_SIZE:
         raise RequestEntityTooLarge
 
-    r = requests.request(method, _config[server]['base_url'] + path, data=data, headers=_config[server]['headers'])
+    session = _session(server)
+    url = _config[server]['base_url'] + path
+    labels = (_config[server]['name'], method, _endpoint(path))
+    start = time.perf_counter()
+    try:
+        with metrics.get('desecapi_pdns_requests_in_progress').labels(_config[server]['name']).track_inprogress():
+            r = session.request(method, url, data=data, timeout=settings.PDNS_TIMEOUT)
+    except requests.RequestException:
+        metrics.get('desecapi_pdns_request_failure').labels(*labels, 'error').inc()
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        metrics.get('desecapi_pdns_request_duration').labels(*labels).observe(duration)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.add(duration)
+    _update_pool_metrics(server, session, url)
     if r.status_code not in range(200, 300):
+        metrics.get('desecapi_pdns_request_failure').labels(*labels, r.status_code).inc()
         raise PDNSException(response=r)
     metrics.get('desecapi_pdns_request_success').labels(method, r.status_code).inc()
     return r
@@ -77,6 +191,31 @@ def _pdns_delete(server, path):
     return _pdns_request('delete', server=server, path=path)
 
 
+def encode_rrsets_chunked(rrsets, max_size=None):
+    """
+    Encodes the given RRsets into JSON bodies for zone PATCH requests, each at most max_size bytes long (default:
+    settings.PDNS_MAX_BODY_SIZE). RRsets are encoded one by one, so that only the current chunk is held in memory
+    in serialized form.
+
+    Yields tuples of the encoded body and the number of RRsets it contains. Yields nothing if there are no RRsets.
+    Raises RequestEntityTooLarge if a single RRset does not fit into a request.
+    """
+    max_size = max_size or settings.PDNS_MAX_BODY_SIZE
+    prefix, separator, suffix = b'{"rrsets": [', b', ', b']}'
+    chunk, size = [], len(prefix) + len(suffix)
+    for rrset in rrsets:
+        encoded = json.dumps(rrset).encode()
+        if len(prefix) + len(encoded) + len(suffix) > max_size:
+            raise RequestEntityTooLarge
+        if chunk and size + len(separator) + len(encoded) > max_size:
+            yield prefix + separator.join(chunk) + suffix, len(chunk)
+            chunk, size = [], len(prefix) + len(suffix)
+        size += len(encoded) + (len(separator) if chunk else 0)
+        chunk.append(encoded)
+    if chunk:
+        yield prefix + separator.join(chunk) + suffix, len(chunk)
+
+
 def pdns_id(name):
     # See also pdns code, apiZoneNameToId() in ws-api.cc (with the exception of forward slash)
     if not re.match(r'^[a-zA-Z0-9_.-]+$', name):
@@ -86,20 +225,65 @@ def pdns_id(name):
     return name.rstrip('.') + '.'
 
 
+def _keys_cache_key(name):
+    return f'desecapi.pdns.keys.{name}'
+
+
 def get_keys(domain):
     """
-    Retrieves a dict representation of the DNSSEC key information
+    Retrieves a dict representation of the DNSSEC key information. Results are cached, see invalidate_keys().
     """
     def _filter_ds(key):
         key['ds'] = [ds for ds in key['ds'] if int(ds.split()[2]) in [2, 4]]
         return key
 
+    cache_key = _keys_cache_key(domain.name)
+    keys = cache.get(cache_key)
+    if keys is not None:
+        metrics.get('desecapi_pdns_keys_cache_hit').inc()
+        return keys
+    metrics.get('desecapi_pdns_keys_cache_miss').inc()
+
     r = _pdns_get(NSLORD, '/zones/%s/cryptokeys' % pdns_id(domain.name))
     metrics.get('desecapi_pdns_keys_fetched').inc()
     keys = [{k: key[k] for k in ('dnskey', 'ds', 'flags', 'keytype')}
              for key in r.json()
              if key['published'] and key['keytype'] in ['csk', 'ksk']]
-    return list(map(_filter_ds, keys))
+    keys = list(map(_filter_ds, keys))
+    if keys:  # don't cache the absence of keys, which is not expected to last
+        cache.set(cache_key, keys, timeout=settings.PDNS_KEYS_CACHE_TIMEOUT)
+    return keys
+
+
+def invalidate_keys(name):
+    """
+    Removes the DNSSEC key information of the given zone from the cache. This needs to be called whenever the keys
+    change, i.e. on zone creation and deletion, and after key rollovers (see `manage.py invalidate-keys`).
+    """
+    cache.delete(_keys_cache_key(name))
+
+
+def _axfr_cache_key(name):
+    return f'desecapi.pdns.axfr.{name}'
+
+
+def axfr_retrieve(name, changed):
+    """
+    Asks nsmaster to retrieve the given zone from nslord, unless another process already did so after the zone was
+    changed on nslord (at time `changed`, as returned by time.time()). In that case, the zone transfer it caused
+    includes the change, and nothing is sent.
+    :return: True if the request was sent, False otherwise.
+    """
+    key = _axfr_cache_key(name)
+    sent = cache.get(key)
+    if sent is not None and sent > changed:
+        metrics.get('desecapi_pdns_axfr_coalesced').inc()
+        return False
+    # Record the time before the request (changes after that may not be included), once the request succeeded
+    sending = time.time()
+    _pdns_put(NSMASTER, '/zones/%s/axfr-retrieve' % pdns_id(name))
+    cache.set(key, sending, timeout=settings.PDNS_AXFR_CACHE_TIMEOUT)
+    return True
 
 
 def get_zone(domain):
@@ -148,3 +332,15 @@ def construct_catalog_rrset(zone=None, delete=False, subname=None, qtype='PTR',
 
 def get_serials():
     return {zone['name']: zone['edited_serial'] for zone in _pdns_get(NSMASTER, '/zones').json()}
+
+
+def get_serial(name):
+    """
+    Returns the serial of the given zone on nsmaster, or None if the zone does not exist there.
+    """
+    try:
+        return _pdns_get(NSMASTER, '/zones/%s?rrsets=false' % pdns_id(name)).json()['edited_serial']
+    except PDNSException as e:
+        if e.response.status_code == 404:
+            return None
+        raise
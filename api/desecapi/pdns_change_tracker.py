@@ -1,4 +1,8 @@
 import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 
 from django.conf import settings
 from django.db.models.signals import post_save, post_delete
@@ -6,9 +10,13 @@ from django.db.transaction import atomic
 from django.utils import timezone
 
 from desecapi import metrics, replication
-from desecapi.models import RRset, RR, Domain
-from desecapi.pdns import _pdns_post, NSLORD, NSMASTER, _pdns_delete, _pdns_patch, _pdns_put, pdns_id, \
-    construct_catalog_rrset
+from desecapi.exceptions import PDNSPartialUpdateException
+from desecapi.models import RRset, RR, RRsetOutbox, Domain, ZoneChange
+from desecapi.pdns import _pdns_post, NSLORD, NSMASTER, _pdns_delete, _pdns_patch, axfr_retrieve, pdns_id, \
+    construct_catalog_rrset, encode_rrsets_chunked, invalidate_keys
+
+
+_catalog_lock = threading.Lock()  # concurrent changes (see PDNSChangeTracker._do_concurrently()) share the catalog zone
 
 
 class PDNSChangeTracker:
@@ -65,6 +73,13 @@ class PDNSChangeTracker:
         def axfr_required(self):
             raise NotImplementedError()
 
+        def pdns_prepare(self):
+            """
+            Collects from the database what pdns_do() needs. Runs in the tracker's thread (and transaction), so that
+            pdns_do() does not access the database and can be executed in a different thread.
+            """
+            pass
+
         def pdns_do(self):
             raise NotImplementedError()
 
@@ -72,8 +87,9 @@ class PDNSChangeTracker:
             raise NotImplementedError()
 
         def update_catalog(self, delete=False):
-            content = _pdns_patch(NSMASTER, '/zones/' + pdns_id(settings.CATALOG_ZONE),
-                               {'rrsets': [construct_catalog_rrset(zone=self.domain_name, delete=delete)]})
+            with _catalog_lock:
+                content = _pdns_patch(NSMASTER, '/zones/' + pdns_id(settings.CATALOG_ZONE),
+                                      {'rrsets': [construct_catalog_rrset(zone=self.domain_name, delete=delete)]})
             metrics.get('desecapi_pdns_catalog_updated').inc()
             return content
 
@@ -118,6 +134,7 @@ class PDNSChangeTracker:
             )
 
             self.update_catalog()
+            invalidate_keys(self.domain_name)
 
         def api_do(self):
             rr_set = RRset(
@@ -142,6 +159,7 @@ class PDNSChangeTracker:
             _pdns_delete(NSLORD, '/zones/' + self.domain_pdns_id)
             _pdns_delete(NSMASTER, '/zones/' + self.domain_pdns_id)
             self.update_catalog(delete=True)
+            invalidate_keys(self.domain_name)
 
         def api_do(self):
             pass
@@ -155,48 +173,74 @@ class PDNSChangeTracker:
             self._additions = additions
             self._modifications = modifications
             self._deletions = deletions
+            self._rrsets = None
 
         @property
         def axfr_required(self):
             return True
 
-        def pdns_do(self):
-            data = {
-                'rrsets':
-                    [
-                        {
-                            'name': RRset.construct_name(subname, self._domain_name),
-                            'type': type_,
-                            'ttl': 1,  # some meaningless integer required by pdns's syntax
-                            'changetype': 'REPLACE',  # don't use "DELETE" due to desec-stack#220, PowerDNS/pdns#7501
-                            'records': []
-                        }
-                        for type_, subname in self._deletions
-                    ] + [
-                        {
-                            'name': RRset.construct_name(subname, self._domain_name),
-                            'type': type_,
-                            'ttl': RRset.objects.values_list('ttl', flat=True).get(domain__name=self._domain_name,
-                                                                                   type=type_, subname=subname),
-                            'changetype': 'REPLACE',
-                            'records': [
-                                {'content': rr.content, 'disabled': False}
-                                for rr in RR.objects.filter(
-                                    rrset__domain__name=self._domain_name,
-                                    rrset__type=type_,
-                                    rrset__subname=subname)
-                            ]
-                        }
-                        for type_, subname in (self._additions | self._modifications) - self._deletions
-                    ]
+        def pdns_prepare(self):
+            # Fetch TTLs and records of all added/modified RRsets at once (one query each)
+            keys = (self._additions | self._modifications) - self._deletions
+            rrsets = {
+                (type_, subname): (pk, ttl)
+                for pk, type_, subname, ttl in RRset.objects.filter(
+                    domain__name=self._domain_name,
+                    type__in={type_ for type_, _ in keys},
+                    subname__in={subname for _, subname in keys},
+                ).values_list('pk', 'type', 'subname', 'ttl')
+                if (type_, subname) in keys
             }
+            records = {}
+            for rrset_id, content in RR.objects.filter(
+                    rrset_id__in=[pk for pk, _ in rrsets.values()]).values_list('rrset_id', 'content'):
+                records.setdefault(rrset_id, []).append({'content': content, 'disabled': False})
 
-            if data['rrsets']:
-                _pdns_patch(NSLORD, '/zones/' + self.domain_pdns_id, data)
+            self._rrsets = [
+                {
+                    'name': RRset.construct_name(subname, self._domain_name),
+                    'type': type_,
+                    'ttl': 1,  # some meaningless integer required by pdns's syntax
+                    'changetype': 'REPLACE',  # don't use "DELETE" due to desec-stack#220, PowerDNS/pdns#7501
+                    'records': []
+                }
+                for type_, subname in self._deletions
+            ] + [
+                {
+                    'name': RRset.construct_name(subname, self._domain_name),
+                    'type': type_,
+                    'ttl': rrsets[type_, subname][1],
+                    'changetype': 'REPLACE',
+                    'records': records.get(rrsets[type_, subname][0], []),
+                }
+                for type_, subname in keys
+            ]
+
+        def pdns_do(self):
+            # Large changes are split into several requests of at most settings.PDNS_MAX_BODY_SIZE bytes each
+            applied = 0
+            for body, count in encode_rrsets_chunked(self._rrsets):
+                try:
+                    _pdns_patch(NSLORD, '/zones/' + self.domain_pdns_id, body)
+                except Exception as e:
+                    if not applied:
+                        raise
+                    raise PDNSPartialUpdateException(response=getattr(e, 'response', None), applied=applied,
+                                                     total=len(self._rrsets)) from e
+                applied += count
 
         def api_do(self):
             pass
 
+        def enqueue(self):
+            """
+            Records the changed RRsets in the outbox instead of sending them to pdns (write-behind mode).
+            """
+            RRsetOutbox.objects.bulk_create([
+                RRsetOutbox(domain_name=self._domain_name, type=type_, subname=subname)
+                for type_, subname in self._additions | self._modifications | self._deletions
+            ])
+
         def __str__(self):
             return 'Update RRsets of %s: additions=%s, modifications=%s, deletions=%s' % \
                    (self.domain_name, list(self._additions), list(self._modifications), list(self._deletions))
@@ -252,27 +296,168 @@ class PDNSChangeTracker:
 
         # TODO introduce two phase commit protocol
         changes = self._compute_changes()
-        axfr_required = set()
-        replication_required = set()
+        # Changes of a domain are sent to pdns in the order in which they are committed (see also _reconcile())
+        list(Domain.objects.select_for_update().filter(name__in={change.domain_name for change in changes})
+             .order_by('pk').values_list('pk', flat=True))
+        if settings.PDNS_WRITE_BEHIND:
+            # RRset changes are committed along with their outbox entries and sent to pdns later (see flush())
+            for change in changes:
+                if isinstance(change, PDNSChangeTracker.CreateUpdateDeleteRRSets):
+                    change.enqueue()
+            changes = [change for change in changes
+                       if not isinstance(change, PDNSChangeTracker.CreateUpdateDeleteRRSets)]
+        if settings.PDNS_CONCURRENCY > 1:
+            failed_change, e = self._do_concurrently(changes)
+        else:
+            failed_change, e = self._do_sequentially(changes)
+        changed = time.time()
+        if failed_change is not None:
+            self.transaction.__exit__(type(e), e, e.__traceback__)
+            if isinstance(e, PDNSPartialUpdateException):
+                self._reconcile(failed_change)
+            exc = ValueError(f'For changes {list(map(str, changes))}, {type(e)} occurred during {failed_change}: {str(e)}')
+            raise exc from e
+
+        self.transaction.__exit__(None, None, None)
+
+        self._publish(changes, changed)
+
+    @classmethod
+    def _publish(cls, changes, changed):
+        # Replication and zone transfers are not triggered again if already pending (see schedule_update(),
+        # axfr_retrieve())
+        replication_required = {change.domain_name for change in changes}
+        axfr_required = {change.domain_name for change in changes if change.axfr_required}
+        for name in replication_required:
+            replication.schedule_update(name)
+        cls._map(lambda name: axfr_retrieve(name, changed), axfr_required)
+        Domain.objects.filter(name__in=axfr_required).update(published=timezone.now())
+        ZoneChange.objects.bulk_create([ZoneChange(name=name) for name in replication_required])
+
+    @classmethod
+    def _reconcile(cls, change):
+        """
+        Restores the (rolled back) database state of the RRsets of a change that was only partially applied on nslord,
+        the same way as outbox entries are sent, while holding the domain's row lock. If that fails as well, the
+        entries remain in the outbox and are retried by flush-pdns-outbox (see desecapi_pdns_reconciliations metric).
+        """
+        change.enqueue()
+        try:
+            with atomic():
+                # Keep concurrent trackers of the domain from sending (newer) changes in between (see __exit__())
+                list(Domain.objects.select_for_update().filter(name=change.domain_name).values_list('pk', flat=True))
+                cls.flush(change.domain_name)
+        except Exception as e:
+            metrics.get('desecapi_pdns_reconciliations').labels('failure').inc()
+            print(f'Could not restore database state of {change.domain_name} on pdns: {type(e).__name__} {e}')
+        else:
+            metrics.get('desecapi_pdns_reconciliations').labels('success').inc()
+
+    @classmethod
+    def flush(cls, domain_name):
+        """
+        Sends all RRset changes from the outbox of the given domain to pdns, merged into one update, and publishes
+        them. Entries of domains that no longer exist are discarded.
+
+        No transaction is held while pdns is contacted, so that writers are not blocked on pdns latency. Entries are
+        deleted by ID once the update succeeded, so that entries added meanwhile are kept. As the update is built from
+        the current database state, sending it twice is harmless.
+        :return: The number of outbox entries processed.
+        """
+        entries = list(RRsetOutbox.objects.filter(domain_name=domain_name).values_list('id', 'type', 'subname'))
+        if not entries:
+            return 0
+        ids = [id_ for id_, _, _ in entries]
+        keys = {(type_, subname) for _, type_, subname in entries}
+
+        change = None
+        if Domain.objects.filter(name=domain_name).exists():
+            existing = set(RRset.objects.filter(
+                domain__name=domain_name,
+                type__in={type_ for type_, _ in keys},
+                subname__in={subname for _, subname in keys},
+            ).values_list('type', 'subname')) & keys
+            change = cls.CreateUpdateDeleteRRSets(domain_name, existing, set(), keys - existing)
+            change.pdns_prepare()
+            change.pdns_do()
+        changed = time.time()
+        RRsetOutbox.objects.filter(id__in=ids).delete()
+
+        if change is not None:
+            cls._publish([change], changed)
+        return len(ids)
+
+    @staticmethod
+    def _map(f, iterable):
+        if settings.PDNS_CONCURRENCY > 1:
+            with ThreadPoolExecutor(max_workers=settings.PDNS_CONCURRENCY) as executor:
+                # run in copies of the caller's context, so that pdns request stats are tracked across threads
+                futures = [executor.submit(copy_context().run, f, item) for item in iterable]
+                return [future.result() for future in futures]
+        return list(map(f, iterable))
+
+    @staticmethod
+    def _do_sequentially(changes):
+        """
+        Applies the given changes to pdns and the API one after another, stopping at the first failure.
+        :return: Tuple of the failed change and the exception that occurred, or (None, None).
+        """
         for change in changes:
             try:
+                change.pdns_prepare()
                 change.pdns_do()
                 change.api_do()
-                replication_required.add(change.domain_name)
-                if change.axfr_required:
-                    axfr_required.add(change.domain_name)
             except Exception as e:
-                self.transaction.__exit__(type(e), e, e.__traceback__)
-                exc = ValueError(f'For changes {list(map(str, changes))}, {type(e)} occurred during {change}: {str(e)}')
-                raise exc from e
+                return change, e
+        return None, None
 
-        self.transaction.__exit__(None, None, None)
+    @classmethod
+    def _do_concurrently(cls, changes):
+        """
+        Like _do_sequentially(), but runs the pdns requests of different zones concurrently, with up to
+        settings.PDNS_CONCURRENCY threads. Changes to the same zone are applied in order. Database access
+        (pdns_prepare(), api_do()) remains in the calling thread, and hence in the tracker's transaction.
+
+        Once a change has failed, no further changes are sent; zones whose changes have not started yet are skipped.
+        Changes to other zones which were already sent (or in flight) at that time are, however, applied on pdns while
+        the database is rolled back. (In sequential mode, this is the case only for changes that precede the failed
+        one.)
+        :return: Tuple of the failed change and the exception that occurred, or (None, None).
+        """
+        for change in changes:
+            try:
+                change.pdns_prepare()
+            except Exception as e:
+                return change, e
 
-        for name in replication_required:
-            replication.update.delay(name)
-        for name in axfr_required:
-            _pdns_put(NSMASTER, '/zones/%s/axfr-retrieve' % pdns_id(name))
-        Domain.objects.filter(name__in=axfr_required).update(published=timezone.now())
+        changes_by_zone = {}
+        for change in changes:
+            changes_by_zone.setdefault(change.domain_name, []).append(change)
+
+        failed = threading.Event()
+
+        def _pdns_do(zone_changes):
+            for zone_change in zone_changes:
+                if failed.is_set():
+                    break
+                try:
+                    zone_change.pdns_do()
+                except Exception as zone_e:
+                    failed.set()
+                    return zone_change, zone_e
+            return None, None
+
+        failures = dict(cls._map(_pdns_do, changes_by_zone.values()))
+        for change in changes:
+            if change in failures:
+                return change, failures[change]
+
+        for change in changes:
+            try:
+                change.api_do()
+            except Exception as e:
+                return change, e
+        return None, None
 
     def _compute_changes(self):
         changes = []
@@ -309,13 +494,13 @@ class PDNSChangeTracker:
 
             # Conditions (b) and (c) are already covered in the modifications and deletions list,
             # we filter the additions list to remove newly-added, but empty RR sets
-            additions -= {
-                (type_, subname) for (type_, subname) in additions
-                if not RR.objects.filter(
+            # (one query per domain: fetch which of the added RR sets have records)
+            if additions:
+                additions &= set(RR.objects.filter(
                     rrset__domain__name=domain_name,
-                    rrset__type=type_,
-                    rrset__subname=subname).exists()
-            }
+                    rrset__type__in={type_ for type_, _ in additions},
+                    rrset__subname__in={subname for _, subname in additions},
+                ).values_list('rrset__type', 'rrset__subname').distinct())
 
             if additions | modifications | deletions:
                 changes.append(PDNSChangeTracker.CreateUpdateDeleteRRSets(
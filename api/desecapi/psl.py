@@ -0,0 +1,90 @@
+import os
+import threading
+from hashlib import sha256
+
+import psl_dns
+from django.conf import settings
+from django.core.cache import cache
+
+from desecapi import metrics
+
+
+class Snapshot:
+    """
+    Public Suffix List in the format of https://publicsuffix.org/list/public_suffix_list.dat, matched in memory.
+    """
+
+    def __init__(self, lines):
+        self.rules = set()
+        for line in lines:
+            rule = line.split(maxsplit=1)[0] if line.strip() else ''
+            if not rule or rule.startswith('//'):
+                continue
+            rule = rule.lower()
+            self.rules.add(rule)
+            try:  # also match names given in punycode
+                self.rules.add(rule.encode('idna').decode('ascii'))
+            except UnicodeError:
+                pass
+
+    def get_public_suffix(self, domain):
+        labels = domain.lower().rstrip('.').split('.')
+        for i in range(len(labels)):
+            candidate = '.'.join(labels[i:])
+            if f'!{candidate}' in self.rules:
+                return '.'.join(labels[i + 1:])
+            if candidate in self.rules or (i + 1 < len(labels) and '.'.join(['*'] + labels[i + 1:]) in self.rules):
+                return candidate
+        return labels[-1]  # implicit rule "*"
+
+
+_snapshot = (None, None)  # (mtime, Snapshot)
+_snapshot_lock = threading.Lock()
+
+
+def get_snapshot():
+    """
+    Returns the snapshot stored at settings.PSL_SNAPSHOT_PATH, or None if there is none. The file is read again when
+    it was replaced (see `manage.py update-psl-snapshot`).
+    """
+    global _snapshot
+    if not settings.PSL_SNAPSHOT_PATH:
+        return None
+    try:
+        mtime = os.stat(settings.PSL_SNAPSHOT_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _snapshot_lock:
+        if _snapshot[0] != mtime:
+            with open(settings.PSL_SNAPSHOT_PATH, encoding='utf-8') as f:
+                _snapshot = mtime, Snapshot(f)
+        return _snapshot[1]
+
+
+def _cache_key(domain):
+    return f'desecapi.psl.{sha256(domain.encode()).hexdigest()}'  # domain may not be validated yet
+
+
+class PSL(psl_dns.PSL):
+    """
+    psl_dns.PSL whose answers are cached (in the cache shared by all workers) for settings.PSL_CACHE_TIMEOUT. On a
+    cache miss, the local snapshot is used if available, and the PSL resolver otherwise.
+    """
+
+    def get_public_suffix(self, domain):
+        cache_key = _cache_key(domain)
+        public_suffix = cache.get(cache_key)
+        if public_suffix is not None:
+            metrics.get('desecapi_psl_cache_hit').inc()
+            return public_suffix
+        metrics.get('desecapi_psl_cache_miss').inc()
+
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            public_suffix = snapshot.get_public_suffix(domain)
+            metrics.get('desecapi_psl_lookups').labels('snapshot').inc()
+        else:
+            public_suffix = super().get_public_suffix(domain)
+            metrics.get('desecapi_psl_lookups').labels('resolver').inc()
+        cache.set(cache_key, public_suffix, timeout=settings.PSL_CACHE_TIMEOUT)
+        return public_suffix
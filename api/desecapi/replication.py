@@ -1,14 +1,25 @@
+import fcntl
+import hashlib
+import heapq
 import os
 import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import List
+from typing import Optional
 
 import dns.query
+import dns.xfr
 import dns.zone
 from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Value
+from django.db.models.functions import Mod
 from django.utils import timezone
 
-from desecapi import models
+from desecapi import metrics, models
 
 
 class ReplicationException(Exception):
@@ -28,17 +39,26 @@ class UnsupportedZoneNameException(ReplicationException):
 
 
 class Repository:
-    # TODO replication performance could potentially(*) be further improved by allowing to run multiple AXFR in
-    #  parallel, and then use a file lock to synchronize git file system actions
-    #  (*) but only if the signing server can sign multiple requests in parallel
-
     _config = {
         'user.email': 'api@desec.internal',
         'user.name': 'deSEC API',
     }
 
-    def __init__(self, path):
+    def __init__(self, path, backend=None):
         self.path = path
+        self.backend = (backend or GIT_BACKENDS[settings.ZONE_REPOSITORY_GIT_BACKEND])(self)
+
+    @contextmanager
+    def lock(self):
+        """
+        Serializes git operations of several processes (e.g. replication workers) working on this repository.
+        """
+        fd = os.open(self.path, os.O_RDONLY)  # lock the directory itself, so that no lock file shows up in git
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)  # releases the lock
 
     def _git(self, *args):
         cmd = ['/usr/bin/git'] + list(args)
@@ -52,9 +72,8 @@ class Repository:
                 stdout=subprocess.PIPE,
                 env={'HOME': '/'},  # Celery does not adjust $HOME when dropping privleges
         ) as p:
-            rcode = p.wait()
-            stderr = p.stderr.read()
-            stdout = p.stdout.read()
+            stdout, stderr = p.communicate()  # waiting before reading would block once a pipe buffer is full
+            rcode = p.returncode
             try:
                 stderr, stdout = stderr.decode(), stdout.decode()
             except UnicodeDecodeError:
@@ -82,7 +101,18 @@ class Repository:
         return rcode
 
     def commit_all(self, msg=None):
-        self._git_do('add', '.')
+        with self.lock():
+            self._git_do('add', '.')
+            self._commit_staged(msg)
+
+    def commit(self, paths, msg=None):
+        """
+        Commits the given paths (added, modified, or deleted) only, without scanning the rest of the work tree.
+        """
+        with self.lock():
+            self.backend.commit(paths, msg)
+
+    def _commit_staged(self, msg=None):
         if self._git_check('diff', '--exit-code', '--numstat', '--staged'):
             self._git_do('commit', '-m', msg or 'update')
 
@@ -102,86 +132,720 @@ class Repository:
             return None, None
 
     def remove_history(self, before: datetime):
-        rev = self._git_do('log', f'--before={before.isoformat()}Z', '-1', '--format=%H')
-        with open(os.path.join(self.path, '.git', 'shallow'), 'w') as f:
-            f.writelines([rev])
-        self._git_do('reflog', 'expire', '--expire=now', '--all')
-        self._git_do('gc', '--prune=now')  # prune only
-        self._git_do('gc')  # remaining garbage collection (e.g. compressing file revisions)
+        """
+        Cuts off history before the given time, and repacks the repository to reclaim the space. Only cutting off
+        history takes the repository lock; repacking runs concurrently with commits. Unreachable objects are deleted
+        only once they are older than settings.ZONE_REPOSITORY_PRUNE_GRACE seconds, so that an object which a
+        concurrent commit refers to again is kept (until the next run, when it is reachable).
+        :return: Number of bytes reclaimed, or None if another process is already removing history
+        """
+        with open(os.path.join(self.path, '.git', 'remove-history.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+
+            size = self._size()
+            with self.lock():
+                rev = self._git_do('log', f'--before={before.isoformat()}Z', '-1', '--format=%H')
+                with open(os.path.join(self.path, '.git', 'shallow'), 'w') as f:
+                    f.writelines([rev])
+                self._git_do('reflog', 'expire', '--expire=now', '--all')
+            expiration = f'{settings.ZONE_REPOSITORY_PRUNE_GRACE}.seconds.ago'
+            # cruft packs (instead of loose objects) keep unreachable objects until they expire
+            self._git_do('repack', '-d', '-q', '--cruft', f'--cruft-expiration={expiration}')
+            self._git_do('prune', f'--expire={expiration}')  # loose objects left behind by repack
+            return max(size - self._size(), 0)
+
+    def _size(self) -> int:
+        # count-objects warns about the temporary packs of running fast-import processes
+        cmd, rcode, stdout, stderr = self._git('count-objects', '-v')
+        if rcode != 0:
+            raise GitRepositoryException(f'{cmd} returned nonzero error code',
+                                         cmd=cmd, rcode=rcode, stdout=stdout, stderr=stderr)
+        stats = dict(line.split(': ') for line in stdout.splitlines())
+        return (int(stats['size']) + int(stats['size-pack']) + int(stats['size-garbage'])) * 1024
+
+
+class SubprocessGitBackend:
+    """
+    Commits by running /usr/bin/git for each step.
+    """
+
+    def __init__(self, repository: Repository):
+        self.repository = repository
+
+    def close(self):
+        pass
+
+    def commit(self, paths, msg):
+        # unlike `git add`, update-index accepts paths that are neither in the work tree nor in the index
+        self.repository._git_do('update-index', '--add', '--remove', '--', *paths)
+        self.repository._commit_staged(msg)
+
+
+class FastImportGitBackend:
+    """
+    Commits through a long-lived `git fast-import` process (one per repository and worker process), which writes the
+    blobs and trees of the given paths directly into the object database. Paths whose content did not change are
+    skipped, and no commit is made if nothing changed.
+
+    The index is not updated, so `git status` shows committed changes as reverted. When going back to the subprocess
+    backend, run `git reset` in the repository.
+
+    Each checkpoint writes a new pack. As automatic gc is disabled in zone repositories, packs are consolidated by a
+    geometric repack every settings.ZONE_REPOSITORY_REPACK_CHECKPOINTS checkpoints.
+    """
+    BRANCH = 'refs/heads/main'
+    _processes = {}
+    _checkpoints = {}
+
+    def __init__(self, repository: Repository):
+        self.repository = repository
+
+    def _git_path(self, *args):
+        return os.path.join(self.repository.path, '.git', *args)
+
+    def _generation(self):
+        # Repository.remove_history() rewrites .git/shallow and prunes objects that fast-import may still remember
+        try:
+            return os.stat(self._git_path('shallow')).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @property
+    def _process(self):
+        process, generation = self._processes.get(self.repository.path, (None, None))
+        if process is not None and (process.poll() is not None or generation != self._generation()):
+            self.close()
+            process = None
+        if process is None:
+            process = subprocess.Popen(
+                ['/usr/bin/git', 'fast-import', '--quiet', '--done'],
+                cwd=self.repository.path,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                env={'HOME': '/'},
+            )
+            self._processes[self.repository.path] = process, self._generation()
+        return process
+
+    def close(self, abort=False):
+        process, _ = self._processes.pop(self.repository.path, (None, None))
+        if process is not None and process.poll() is None:
+            if abort:  # fast-import would otherwise finish an unfinished commit and update the branch
+                process.kill()
+            else:
+                process.stdin.write(b'done\n')
+                process.stdin.close()
+            process.wait()
+
+    def repack(self):
+        """
+        Merges the packs written by fast-import (smallest first, so that large packs are rarely rewritten). The
+        process is restarted afterwards, as it keeps reading objects from the packs it wrote.
+        """
+        self.close()
+        self._checkpoints.pop(self.repository.path, None)
+        self.repository._git_do('repack', '-d', '-q', '--geometric=2')
+
+    def _send(self, *chunks: bytes):
+        process = self._process
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+            process.stdin.flush()
+        except BrokenPipeError:
+            self.close(abort=True)
+            raise GitRepositoryException('git fast-import terminated unexpectedly', rcode=process.poll())
+
+    def _readline(self) -> str:
+        line = self._process.stdout.readline()
+        if not line:
+            rcode = self._process.poll()
+            self.close(abort=True)
+            raise GitRepositoryException('git fast-import terminated unexpectedly', rcode=rcode)
+        return line.decode().rstrip('\n')
+
+    def _head(self):
+        try:
+            with open(self._git_path(*self.BRANCH.split('/'))) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            pass
+        try:
+            with open(self._git_path('packed-refs')) as f:
+                for line in f:
+                    if line.rstrip('\n').endswith(' ' + self.BRANCH):
+                        return line.split(' ', 1)[0]
+        except FileNotFoundError:
+            pass
+        return None
+
+    def _modify(self, paths) -> bool:
+        changed = False
+        for path in paths:
+            try:
+                with open(os.path.join(self.repository.path, path), 'rb') as f:
+                    content = f.read()
+            except FileNotFoundError:
+                content = None
+            blob = None if content is None else hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
+            # look up the path in the commit being built (the parent's tree is loaded only once); zone file names
+            # contain no characters that need escaping
+            self._send(f'ls "{path}"\n'.encode())
+            response = self._readline()  # "<mode> <type> <sha>\t<path>" or "missing <path>"
+            committed = None if response.startswith('missing ') else response.split('\t', 1)[0].split(' ')[2]
+            if blob == committed:
+                continue
+            changed = True
+            if content is None:
+                self._send(f'D {path}\n'.encode())
+            else:
+                self._send(f'M 100644 inline {path}\ndata {len(content)}\n'.encode(), content, b'\n')
+        return changed
+
+    def commit(self, paths, msg):
+        head = self._head()
+        msg = (msg or 'update').encode()
+        config = self.repository._config
+        self._send(
+            f'commit {self.BRANCH}\n'.encode(),
+            f'committer {config["user.name"]} <{config["user.email"]}> {int(datetime.now().timestamp())} +0000\n'
+            .encode(),
+            f'data {len(msg)}\n'.encode(), msg, b'\n',
+            f'from {head}\n'.encode() if head is not None else b'',
+        )
+
+        try:
+            changed = self._modify(paths)
+        except BaseException:
+            self.close(abort=True)
+            raise
+
+        if changed:
+            self._send(b'\ncheckpoint\nprogress committed\n')  # checkpoint writes objects and branch to disk
+            line = self._readline()
+            if line != 'progress committed':
+                raise GitRepositoryException('unexpected output from git fast-import', stdout=line)
+            self._checkpoints[self.repository.path] = self._checkpoints.get(self.repository.path, 0) + 1
+            if self._checkpoints[self.repository.path] >= settings.ZONE_REPOSITORY_REPACK_CHECKPOINTS:
+                self.repack()
+        else:
+            # A commit can not be aborted, so point the branch back to its previous commit, without a checkpoint.
+            # (fast-import never rewinds the branch on disk, even if another process committed meanwhile.)
+            self._send(b'\n', f'reset {self.BRANCH}\n'.encode(), f'from {head}\n\n'.encode() if head else b'\n')
+
+
+GIT_BACKENDS = {
+    'subprocess': SubprocessGitBackend,
+    'fast-import': FastImportGitBackend,
+}
+
+
+class ZoneFileWriter:
+    """
+    Writes a zone file in canonical form, so that the diff between two versions of a zone reflects the actual change:
+    names in DNSSEC canonical order (starting with the apex), the SOA first at the apex, then records by type and in
+    canonical order. The output contains no volatile data (like timestamps).
+
+    Records can be added as they arrive. To keep memory usage independent of the zone size, they are sorted in chunks
+    of CHUNK_SIZE records, which are spilled to temporary files and merged when writing.
+    """
+    CHUNK_SIZE = 100_000
+
+    def __init__(self, origin: dns.name.Name, tmp_dir: str):
+        self.origin = origin
+        self.tmp_dir = tmp_dir
+        self.soa = None
+        self.soa_signature = None
+        self._buffer = []
+        self._chunks = []
+
+    @staticmethod
+    def _name_key(name: dns.name.Name) -> str:
+        # labels from the root, hex-encoded so that comparing keys compares the lowercase label octets
+        return ''.join(label.lower().hex() + ',' for label in reversed(name.labels))
+
+    def add(self, name: dns.name.Name, ttl: int, rdata: dns.rdata.Rdata):
+        """
+        Adds a record. The name is relative to the origin. Duplicates are removed when writing.
+        """
+        rdtype, covers = rdata.rdtype, rdata.covers()
+        line = (f'{name} {ttl} {dns.rdataclass.to_text(rdata.rdclass)} {dns.rdatatype.to_text(rdtype)} '
+                f'{rdata.to_text(origin=self.origin, relativize=True)}')
+        if name == dns.name.empty and rdtype == dns.rdatatype.SOA:
+            self.soa = line
+        elif name == dns.name.empty and rdtype == dns.rdatatype.RRSIG and covers == dns.rdatatype.SOA:
+            self.soa_signature = line
+        key = (f'{self._name_key(name)}!{int(rdtype != dns.rdatatype.SOA)}{rdtype:04x}{covers:04x}'
+               f'{rdata.to_digestable(self.origin).hex()}')
+        self._buffer.append(key + '\t' + line)
+        if len(self._buffer) >= self.CHUNK_SIZE:
+            chunk = tempfile.TemporaryFile('w+', dir=self.tmp_dir)
+            chunk.writelines(entry + '\n' for entry in sorted(self._buffer))
+            chunk.seek(0)
+            self._chunks.append(chunk)
+            self._buffer = []
+
+    def _lines(self):
+        self._buffer.sort()
+        for chunk in self._chunks:
+            chunk.seek(0)
+        previous = None
+        for entry in heapq.merge(*[(entry.rstrip('\n') for entry in chunk) for chunk in self._chunks], self._buffer):
+            if entry != previous:
+                yield entry.split('\t', 1)[1] + '\n'
+            previous = entry
+
+    def hash(self) -> str:
+        """
+        Returns the SHA-256 hash of the zone file content, without writing it.
+        """
+        content_hash = hashlib.sha256()
+        for line in self._lines():
+            content_hash.update(line.encode())
+        return content_hash.hexdigest()
+
+    def write(self, f) -> str:
+        """
+        Writes the zone file to the given file object.
+        :return: SHA-256 hash of the zone file content
+        """
+        content_hash = hashlib.sha256()
+        try:
+            for line in self._lines():
+                f.write(line)
+                content_hash.update(line.encode())
+        finally:
+            self.close()
+        return content_hash.hexdigest()
+
+    def close(self):
+        for chunk in self._chunks:
+            chunk.close()
 
 
 class ZoneRepository(Repository):
     AXFR_SOURCE = '172.16.1.11'
+    LAYOUTS = {  # zone file path by zone name
+        'flat': lambda name: name + '.zone',
+        'hash': lambda name: os.path.join(hashlib.sha256(name.encode()).hexdigest()[:2], name + '.zone'),
+    }
 
-    def __init__(self, path):
-        super().__init__(path)
+    def __init__(self, path, backend=None):
+        super().__init__(path, backend)
         self._config['gc.auto'] = '0'
-        if not os.path.exists(os.path.join(self.path, '.git')):
-            self.init()
+        with self.lock():
+            recovery = not os.path.exists(os.path.join(self.path, '.git'))
+            if recovery:
+                self.init()
+                self._write_layout(settings.ZONE_REPOSITORY_LAYOUT)
+            self.layout = self._read_layout()
+        if recovery:
             self.commit_all(msg='Inception or Recovery')
             update_all.delay()
 
+    def _read_layout(self):
+        try:
+            with open(os.path.join(self.path, '.git', 'zone-layout')) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return 'flat'  # repositories from before layouts were introduced
+
+    def _write_layout(self, layout):
+        with open(os.path.join(self.path, '.git', 'zone-layout'), 'w') as f:
+            f.write(layout)
+
+    def zone_path(self, name: str) -> str:
+        """
+        Returns the path of the given zone's file, relative to the repository.
+        """
+        return self.LAYOUTS[self.layout](name)
+
+    def _zone_filename(self, name: str) -> str:
+        return os.path.join(self.path, self.zone_path(name))
+
+    def migrate_layout(self, layout: str) -> int:
+        """
+        Moves all zone files to the paths of the given layout, and commits the result. Replication must not run
+        meanwhile, as it may write zone files to paths of the previous layout.
+        :return: Number of zone files moved
+        """
+        moved = 0
+        with self.lock():
+            for directory, subdirectories, filenames in os.walk(self.path):
+                if directory == self.path:
+                    subdirectories.remove('.git')
+                for filename in filenames:
+                    if not filename.endswith('.zone'):
+                        continue
+                    source = os.path.join(directory, filename)
+                    target = os.path.join(self.path, self.LAYOUTS[layout](filename[:-len('.zone')]))
+                    if source != target:
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                        os.rename(source, target)
+                        moved += 1
+            for directory, _, _ in list(os.walk(self.path, topdown=False)):
+                if directory != self.path and not directory.startswith(os.path.join(self.path, '.git')):
+                    try:
+                        os.rmdir(directory)
+                    except OSError:  # not empty
+                        pass
+            self._write_layout(layout)
+            self.layout = layout
+        self.commit_all(f'Move zone files to {layout} layout')
+        return moved
+
+    @contextmanager
+    def zone_lock(self, name):
+        """
+        Serializes refreshes of the given zone, so that an older AXFR can not overwrite the result of a newer one.
+        Zones share a fixed number of lock files (by hash of their name), so that lock files do not accumulate as
+        zones come and go. (Removing the lock file of a deleted zone would race with processes waiting for it.)
+        """
+        path = os.path.join(self.path, '.git', 'zone-locks')
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, hashlib.sha256(name.encode()).hexdigest()[:2]), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def add_pending(self, name) -> int:
+        """
+        Marks the given zone for the next commit (see commit_pending()).
+        :return: The number of zone updates pending for commit
+        """
+        with self.lock(), open(os.path.join(self.path, '.git', 'pending-zones'), 'a+') as f:
+            f.write(name + '\n')
+            f.seek(0)
+            return len(f.readlines())
+
+    def is_pending(self, name) -> bool:
+        """
+        Returns whether the given zone is marked for the next commit (see add_pending()).
+        """
+        with self.lock(), open(os.path.join(self.path, '.git', 'pending-zones'), 'a+') as f:
+            f.seek(0)
+            return name in f.read().split()
+
+    def commit_pending(self) -> list:
+        """
+        Commits all zones marked with add_pending() in a single commit.
+        :return: Names of the committed zones
+        """
+        with self.lock(), open(os.path.join(self.path, '.git', 'pending-zones'), 'a+') as f:
+            f.seek(0)
+            names = sorted(set(f.read().split()))
+            if not names:
+                return []
+            paths = [self.zone_path(name) for name in names]
+            with metrics.get('desecapi_replication_stage_duration').labels('commit').time():
+                if len(names) == 1:
+                    self.backend.commit(paths, f'Update for {names[0]}')
+                else:
+                    self.backend.commit(paths, f'Update for {len(names)} zones\n\n' + '\n'.join(names))
+            f.truncate(0)
+        return names
+
     def refresh(self, name):
         if '/' in name or '\x00' in name:
             raise UnsupportedZoneNameException
 
-        # obtain AXFR
-        timeout = 60  # if AXFR take longer, the timeout must be increased (see also settings.py)
+        with self.zone_lock(name):
+            return self._refresh(name)
+
+    def _refresh(self, name) -> bool:
+        """
+        Updates the zone file of the given zone.
+        :return: Whether the zone file changed (or was deleted)
+        """
+        # Try IXFR based on the zone file's serial; fall back to AXFR if there is no usable zone file, or if IXFR fails
+        # (e.g. when the source has no journal for our serial). The source may also answer with a full zone.
+        serial = self._read_serial(name)
         try:
-            xfr = list(dns.query.xfr(self.AXFR_SOURCE, name, timeout=timeout))
-        except dns.query.TransferError as e:
+            if serial is not None:
+                try:
+                    writer = self._transfer(name, dns.rdatatype.IXFR, serial)
+                except (dns.query.TransferError, dns.xfr.TransferError, dns.exception.FormError) as e:
+                    if getattr(e, 'rcode', None) == dns.rcode.Rcode.NOTAUTH:
+                        raise
+                    print(f'IXFR for {name} failed ({type(e).__name__}: {e}), falling back to AXFR')
+                    writer = self._transfer(name, dns.rdatatype.AXFR)
+                if writer is None:
+                    print(f'{name} is up to date')
+                    return False
+            else:
+                writer = self._transfer(name, dns.rdatatype.AXFR)
+        except (dns.query.TransferError, dns.xfr.TransferError) as e:
             if e.rcode == dns.rcode.Rcode.NOTAUTH:
                 self._delete_zone(name)
+                return True
             else:
                 raise
         else:
-            self._update_zone(name, xfr)
+            return self._update_zone(name, writer)
 
-    def _update_zone(self, name: str, xfr: List[dns.message.QueryMessage]):
-        z = dns.zone.from_xfr(xfr, check_origin=False)
+    def _read_serial(self, name: str) -> Optional[int]:
+        # The SOA record is the first line of zone files written by ZoneFileWriter
+        try:
+            with open(self._zone_filename(name)) as f:
+                zone = dns.zone.from_text(f.readline(), origin=name, check_origin=False)
+        except FileNotFoundError:
+            return None
+        except dns.exception.DNSException as e:
+            print(f'WARNING could not read SOA from zone file of {name} ({type(e).__name__}: {e})')
+            return None
+        soa = zone.get_rdataset('@', dns.rdatatype.SOA)
+        return soa[0].serial if soa else None
+
+    def _read_zone(self, name: str) -> dns.zone.Zone:
         try:
-            print(f'New SOA for {name}: '
-                  f'{z.get_rrset(name="", rdtype=dns.rdatatype.SOA).to_text()}')
-            print(f'         Signature: '
-                  f'{z.get_rrset(name="", rdtype=dns.rdatatype.RRSIG, covers=dns.rdatatype.SOA).to_text()}')
-        except AttributeError:
+            return dns.zone.from_file(self._zone_filename(name), origin=name, check_origin=False)
+        except (OSError, dns.exception.DNSException) as e:
+            raise dns.exception.FormError(f'could not read zone file ({type(e).__name__}: {e})')
+
+    def _transfer(self, name: str, rdtype: dns.rdatatype.RdataType, serial=0) -> Optional[ZoneFileWriter]:
+        with metrics.get('desecapi_replication_stage_duration').labels('transfer').time():
+            return self.__transfer(name, rdtype, serial)
+
+    def __transfer(self, name: str, rdtype: dns.rdatatype.RdataType, serial=0) -> Optional[ZoneFileWriter]:
+        """
+        Runs a zone transfer of the given type (AXFR, or IXFR from the given serial) from AXFR_SOURCE.
+        Full zones are streamed into the returned writer; incremental responses are applied to the zone file's
+        content first.
+        :return: A writer holding the zone's records, or None if IXFR found the zone up to date.
+        """
+        timeout = 60  # if AXFR take longer, the timeout must be increased (see also settings.py)
+        origin = dns.name.from_text(name)
+        kind, records, inbound, writer, messages = dns.rdatatype.to_text(rdtype).lower(), 0, None, None, []
+        for message in dns.query.xfr(self.AXFR_SOURCE, origin, rdtype=rdtype, serial=serial, timeout=timeout):
+            records += sum(len(rrset) for rrset in message.answer)
+            messages.append(message)
+            if inbound is None and writer is None:
+                # Wait for the second record to tell an incremental response (SOA) from a full one (anything else)
+                rrsets = [rrset for m in messages for rrset in m.answer][:2]
+                if len(rrsets) < 2:
+                    continue
+                if rdtype == dns.rdatatype.IXFR and rrsets[1].rdtype == dns.rdatatype.SOA:
+                    zone = self._read_zone(name)
+                    inbound = dns.xfr.Inbound(zone, rdtype, serial)
+                else:
+                    kind = 'axfr'
+                    writer = ZoneFileWriter(origin, os.path.join(self.path, '.git'))
+            for m in messages:
+                if inbound is not None:
+                    # dns.query.xfr() has checked the message; the question is dropped, as it says IXFR even if
+                    # the source answers with a full zone
+                    m.question = []
+                    inbound.process_message(m)
+                else:
+                    for rrset in m.answer:
+                        for rdata in rrset:
+                            writer.add(rrset.name, rrset.ttl, rdata)
+            messages = []
+
+        metrics.get('desecapi_replication_transfers').labels(kind).inc()
+        metrics.get('desecapi_replication_transfer_records').labels(kind).inc(records)
+        if inbound is not None:
+            writer = ZoneFileWriter(origin, os.path.join(self.path, '.git'))
+            for rname, ttl, rdata in zone.iterate_rdatas():
+                writer.add(rname, ttl, rdata)
+        elif writer is None:  # IXFR response consisting of the current SOA only
+            if messages[0].answer[0][0].serial != serial:
+                raise dns.xfr.SerialWentBackwards
+        return writer
+
+    def _hash_filename(self, name: str):
+        return os.path.join(self.path, '.git', 'zone-hashes', name)
+
+    def _update_zone(self, name: str, writer: ZoneFileWriter) -> bool:
+        if writer.soa is not None:
+            print(f'New SOA for {name}: {writer.soa}')
+            print(f'         Signature: {writer.soa_signature}')
+        else:
             print(f'WARNING {name} has no SOA record?!')
 
-        # TODO sort AXFR? (but take care with SOA)
-        #  stable output can be achieved with
-        #  output = '\n'.join(sorted('\n'.split(z.to_text())))
-        #  but we need to see first if the frontend can handle this messed up zone file
-
-        # write zone file
-        filename = os.path.join(self.path, name + '.zone')
-        with open(filename + '~', 'w') as f:
-            f.write(f'; Generated by deSEC at {datetime.utcnow()}Z\n')  # TODO if sorting, remove this to avoid overhead
-            z.to_file(f)
-        os.rename(filename + '~', filename)
+        # write zone file, unless its content is unchanged (temporary file is kept out of the work tree, as other
+        # workers may commit meanwhile)
+        filename = self._zone_filename(name)
+        tmp_filename = os.path.join(self.path, '.git', name + '.zone~')
+        with metrics.get('desecapi_replication_stage_duration').labels('write').time():
+            try:
+                with open(self._hash_filename(name)) as f:
+                    stored_hash = f.read()
+            except FileNotFoundError:
+                stored_hash = None
+            if stored_hash is not None and os.path.exists(filename) and writer.hash() == stored_hash:
+                print(f'{name} is unchanged')
+                writer.close()
+                return False
+            with open(tmp_filename, 'w') as f:
+                content_hash = writer.write(f)
+            metrics.get('desecapi_replication_written_bytes').inc(os.path.getsize(tmp_filename))
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            os.rename(tmp_filename, filename)
+            # written after the zone file, so that an interruption in between leads to a rewrite, not to a skip
+            os.makedirs(os.path.dirname(self._hash_filename(name)), exist_ok=True)
+            with open(self._hash_filename(name), 'w') as f:
+                f.write(content_hash)
+        return True
 
     def _delete_zone(self, name: str):
-        os.remove(os.path.join(self.path, name + '.zone'))
+        os.remove(self._zone_filename(name))
+        try:
+            os.remove(self._hash_filename(name))
+        except FileNotFoundError:
+            pass
 
 
 ZONE_REPOSITORY_PATH = '/zones'
 
 
-@shared_task(queue='replication')
-def update(name: str):
-    # TODO this task runs through following steps:
-    #  (1) retrieve AXFR  (dedyn.io 01/2021: 8.5s)
-    #  (2) parse AXFR     (dedyn.io 01/2021: 1.8s)
-    #  (3) write AXFR into zone file (dedyn.io 01/2021: 2.3s)
-    #  (4) commit into git repository  (dedyn.io 01/2021: 0.5s)
-    #  To enhance performance, steps 1-3 can be executed in parallel for multiple zones with multiprocessing.
-    #  Step 4, which takes 0.5s even for very large zones, can only be executed by a single worker, as
-    #  two parallel git commits will fail
+def _pending_key(name: str):
+    return f'desecapi.replication.pending.{name}'
+
+
+def _started_key(name: str):
+    return f'desecapi.replication.started.{name}'
+
+
+_COMMIT_PENDING_KEY = 'desecapi.replication.pending-commit'
+_ROTATION_POSITION_KEY = 'desecapi.replication.rotation-position'
+
+
+def rotation_cycle_start(now: datetime) -> datetime:
+    """
+    Returns the start of the current signature rotation cycle (the last Thursday, 00:00 UTC).
+    """
+    start = now.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return start - timedelta(days=(start.weekday() - 3) % 7)
+
+
+def rotation_slot(domain_id: int) -> int:
+    """
+    Returns the rotation time of the given zone, in seconds after the start of the rotation cycle. Zones are spread
+    evenly (by primary key of their domain) over settings.REPLICATION_ROTATION_WINDOW. Keep in sync with
+    _rotation_slot_expression().
+    """
+    return domain_id % settings.REPLICATION_ROTATION_WINDOW
+
+
+def _rotation_slot_expression():
+    return Mod('pk', Value(settings.REPLICATION_ROTATION_WINDOW))
+
+
+def schedule_update(name: str):
+    """
+    Queues replication of the given zone, unless replication of the zone is already pending (i.e., queued, but not yet
+    started). The pending task will then pick up the current zone. A run is queued right away, unless the previous one
+    started less than settings.REPLICATION_DEBOUNCE seconds ago; it is then delayed until that time has passed, so
+    that bursts of changes are replicated together.
+    """
+    if not cache.add(_pending_key(name), True, timeout=settings.REPLICATION_PENDING_TIMEOUT):
+        metrics.get('desecapi_replication_coalesced').inc()
+        return
+    started = cache.get(_started_key(name))
+    countdown = 0 if started is None else max(0, started + settings.REPLICATION_DEBOUNCE - time.time())
+    try:
+        update.apply_async((name,), countdown=countdown)
+    except BaseException:
+        cache.delete(_pending_key(name))  # nothing was queued, so that the next change must try again
+        raise
+
+
+@shared_task(queue='replication', priority=5)  # higher than signature rotation (see rotate())
+def update(name: str, rotation: float = None):
+    """
+    Replicates the given zone. If `rotation` is given (timestamp of queuing for signature rotation), replication is
+    skipped if the zone has been replicated since.
+    """
+    cache.delete(_pending_key(name))  # changes from now on need another run
+    cache.set(_started_key(name), time.time(), timeout=settings.REPLICATION_DEBOUNCE)
+    if rotation is not None and models.Domain.objects.filter(
+            name=name, replicated__gte=datetime.fromtimestamp(rotation, timezone.utc)).exists():
+        metrics.get('desecapi_replication_rotation_skipped').inc()
+        return
+    # This task runs through following steps (see desecapi_replication_stage_duration metric):
+    #  (1) transfer: retrieve and parse AXFR/IXFR (dedyn.io 01/2021: 8.5s + 1.8s)
+    #  (2) write: write zone file (dedyn.io 01/2021: 2.3s)
+    #  (3) commit: commit into git repository  (dedyn.io 01/2021: 0.5s)
+    #  Steps 1-2 run in parallel for several zones when the replication worker runs with concurrency > 1.
+    #  Step 3 is serialized with a lock on the repository, as two parallel git commits will fail. It is batched: zones
+    #  written within settings.REPLICATION_COMMIT_WINDOW seconds go into one commit (see commit()).
     print(f'updating {name}')
     t = timezone.now()
     zones = ZoneRepository(ZONE_REPOSITORY_PATH)
-    zones.refresh(name)
-    zones.commit_all(f'Update for {name}')
-    models.Domain.objects.filter(name=name).update(replicated=timezone.now(), replication_duration=timezone.now() - t)
+    changed = zones.refresh(name)
+    models.Domain.objects.filter(name=name).update(replication_duration=timezone.now() - t)
+    if not changed:
+        metrics.get('desecapi_replication_unchanged').inc()
+        if not zones.is_pending(name):  # otherwise, the pending commit marks it as replicated
+            mark_replicated([name])
+    elif zones.add_pending(name) >= settings.REPLICATION_COMMIT_MAX_ZONES:
+        _commit_pending(zones)
+    else:
+        schedule_commit()
+
+
+def mark_replicated(names):
+    """
+    Records that the current state of the given zones has been committed.
+    """
+    now = timezone.now()
+    domains = models.Domain.objects.filter(name__in=names)
+    for published in domains.filter(published__isnull=False).values_list('published', flat=True):
+        metrics.get('desecapi_replication_delay').observe((now - published).total_seconds())
+    domains.update(replicated=now)
+
+
+def _commit_pending(zones):
+    try:
+        names = zones.commit_pending()
+    except BaseException:
+        schedule_commit()  # retry, as the pending zones would otherwise wait for the next update
+        raise
+    mark_replicated(names)
+
+
+def schedule_commit():
+    """
+    Queues a commit of pending zone updates after settings.REPLICATION_COMMIT_WINDOW seconds, unless one is already
+    queued.
+    """
+    if cache.add(_COMMIT_PENDING_KEY, True, timeout=settings.REPLICATION_PENDING_TIMEOUT):
+        commit.apply_async(countdown=settings.REPLICATION_COMMIT_WINDOW, priority=9)
+
+
+@shared_task(queue='replication')
+def commit():
+    cache.delete(_COMMIT_PENDING_KEY)  # zones added from now on need another commit
+    _commit_pending(ZoneRepository(ZONE_REPOSITORY_PATH))
+
+
+@shared_task(queue='replication', priority=9)
+def rotate():
+    """
+    Queues replication for signature rotation of all zones whose rotation slot (see rotation_slot()) has passed since
+    the previous run, at low priority. Zones with a pending replication are skipped.
+    """
+    now = timezone.now()
+    start = rotation_cycle_start(now)
+    position = min((now - start).total_seconds(), settings.REPLICATION_ROTATION_WINDOW)
+    previous = cache.get(_ROTATION_POSITION_KEY)  # (cycle start, position) of the previous run
+    if previous is not None and previous[0] == start:
+        begin = previous[1]
+    else:  # new cycle (or unknown progress, e.g. after a cache restart)
+        begin = position - settings.REPLICATION_ROTATION_INTERVAL if previous is None else 0
+    cache.set(_ROTATION_POSITION_KEY, (start, position), timeout=7 * 24 * 3600)
+
+    # the slot is computed by the database, so that each run only loads the zones of its share
+    names = models.Domain.objects.annotate(rotation_slot=_rotation_slot_expression()).filter(
+        rotation_slot__gte=begin, rotation_slot__lt=position).values_list('name', flat=True)
+    names = [name for name in names if not cache.get(_pending_key(name))]
+    print(f'Queuing replication for signature rotation of {len(names)} zones.')
+    for name in names:
+        update.apply_async((name,), {'rotation': now.timestamp()}, priority=1)
+    metrics.get('desecapi_replication_rotation_queued').inc(len(names))
 
 
 @shared_task(queue='replication', priority=9)
@@ -197,4 +861,10 @@ def remove_history():
     before = datetime.now() - timedelta(days=2)
     print(f'Cleaning repo data from before {before}')
     zones = ZoneRepository(ZONE_REPOSITORY_PATH)
-    zones.remove_history(before=before)
+    with metrics.get('desecapi_replication_prune_duration').time():
+        reclaimed = zones.remove_history(before=before)
+    if reclaimed is None:
+        print('History removal already in progress, skipping')
+    else:
+        print(f'Reclaimed {reclaimed} bytes')
+        metrics.get('desecapi_replication_prune_reclaimed_bytes').inc(reclaimed)
@@ -540,11 +540,11 @@ class RRsetSerializer(ConditionalExistenceModelSerializer):
         Updates this RR set's resource records, discarding any old values.
 
         :param rrset: the RRset at which we overwrite all RRs
-        :param rrs: list of RR representations
+        :param rrs: list of RR representations (as validated by RRsetSerializer.validate, hence in canonical format)
         """
         record_contents = [rr['content'] for rr in rrs]
         try:
-            rrset.save_records(record_contents)
+            rrset.save_records(record_contents, canonical=True)
         except django.core.exceptions.ValidationError as e:
             raise serializers.ValidationError(e.messages, code='record-content')
 
@@ -11,6 +11,7 @@ from unittest import mock
 
 from django.conf import settings
 from django.contrib.auth.hashers import check_password
+from django.core.cache import cache
 from django.db import connection
 from httpretty import httpretty, core as hr_core
 from rest_framework.reverse import reverse
@@ -563,7 +564,7 @@ class MockPDNSTestCase(APITestCase):
         self.assertEqual(len(Token.make_hash(plain).split('$')), 4)
 
     def assertReplication(self, name):
-        replication.update.delay.assert_called_with(name)
+        replication.update.apply_async.assert_any_call((name,), countdown=0)
 
     @classmethod
     def setUpTestData(cls):
@@ -620,6 +621,7 @@ class MockPDNSTestCase(APITestCase):
             ]
 
         super().setUp()
+        cache.clear()  # e.g. DNSSEC keys cached during test data setup
         httpretty.reset()
         hr_core.POTENTIAL_HTTP_PORTS.add(8081)  # FIXME should depend on self.expected_requests
         for method in [
@@ -636,7 +638,7 @@ class MockPDNSTestCase(APITestCase):
                 )
 
         # configure mocks for replication
-        self._mock_replication = mock.patch('desecapi.replication.update.delay', return_value=None, wraps=None)
+        self._mock_replication = mock.patch('desecapi.replication.update.apply_async', return_value=None, wraps=None)
         self._mock_replication.start()
 
     def tearDown(self) -> None:
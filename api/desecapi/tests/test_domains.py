@@ -154,6 +154,25 @@ class IsRegistrableTestCase(DesecTestCase, PublicSuffixMockMixin):
         self.assertNotRegistrable('catalog.internal')
         self.assertNotRegistrable('some.other.internal')
 
+    def test_covers_foreign_zone(self):
+        user_a, user_b = self.create_user(), self.create_user()
+        Domain(name='sub.example.com', owner=user_b).save()
+        Domain(name='fooexample.com', owner=user_b).save()
+        Domain(name='a.b.mine.example', owner=user_a).save()
+
+        # descendant zone owned by another user
+        self.assertTrue(Domain(name='example.com', owner=user_a).covers_foreign_zone())
+        self.assertTrue(Domain(name='example.com').covers_foreign_zone())
+        # ... but not if owned by the same user
+        self.assertFalse(Domain(name='example.com', owner=user_b).covers_foreign_zone())
+        self.assertFalse(Domain(name='mine.example', owner=user_a).covers_foreign_zone())
+        self.assertTrue(Domain(name='mine.example', owner=user_b).covers_foreign_zone())
+        # names sharing a suffix without a label boundary are not descendants
+        self.assertFalse(Domain(name='ample.com', owner=user_a).covers_foreign_zone())
+        self.assertFalse(Domain(name='oexample.com', owner=user_a).covers_foreign_zone())
+        # a zone does not cover itself
+        self.assertFalse(Domain(name='sub.example.com', owner=user_a).covers_foreign_zone())
+
 
 class UnauthenticatedDomainTests(DesecTestCase):
 
@@ -290,7 +309,7 @@ class DomainOwnerTestCase1(DomainOwnerTestCase):
                 self.assertEqual(len(mail.outbox), 0)
                 self.assertTrue(isinstance(response.data['keys'], list))
 
-            with self.assertPdnsRequests(self.request_pdns_zone_retrieve_crypto_keys(name)):
+            with self.assertPdnsRequests():  # keys are cached since domain creation
                 self.assertStatus(
                     self.client.get(self.reverse('v1:domain-detail', name=name), {'name': name}),
                     status.HTTP_200_OK
@@ -521,7 +540,27 @@ class DomainManagerTestCase(DesecTestCase):
                     qs = Domain.objects.filter_qname(qname, **filter_kwargs).values_list('name', flat=True)
                     self.assertListEqual(list(qs), expected)
 
+    def test_filter_qname_ancestors_only(self):
+        user = self.create_user()
+        for name in ['example.com', 'sub.example.com', 'ample.com']:
+            Domain(name=name, owner=user).save()
+
+        for qname, expected in {
+            'a.b.c.d.example.com': ['example.com'],  # deeper than the zone
+            'a.b.sub.example.com': ['example.com', 'sub.example.com'],
+            'example.com': ['example.com'],  # zone apex
+            'sub.example.com': ['example.com', 'sub.example.com'],
+            'xexample.com': [],  # sibling sharing a suffix, but not a parent
+            'foo.xexample.com': [],
+            'subexample.com': [],
+            'com': [],
+        }.items():
+            for qname in [qname, f'*.{qname}']:
+                qs = Domain.objects.filter_qname(qname).values_list('name', flat=True)
+                self.assertCountEqual(qs, expected, qname)
+
     def test_filter_qname_invalid(self):
-        for qname in ['foo@bar.com', '*.*.example.com', '*foo.example.com', 'foo.*.example.com']:
+        for qname in ['foo@bar.com', '*.*.example.com', '*foo.example.com', 'foo.*.example.com',
+                      'Example.com', 'foo.EXAMPLE.com', 'example.com.', '*.example.com.', '.example.com']:
             with self.assertRaises(ValueError):
                 Domain.objects.filter_qname(qname)
@@ -0,0 +1,183 @@
+import json
+import os
+import time
+from io import StringIO
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from django.core.management import call_command, CommandError
+from django.test import SimpleTestCase
+from httpretty import httpretty
+from prometheus_client import REGISTRY
+
+from desecapi import metrics, pdns
+from desecapi.exceptions import PDNSException, RequestEntityTooLarge
+from desecapi.tests.base import DesecTestCase
+
+
+class PdnsClientTestCase(DesecTestCase):
+
+    domain = None
+
+    @classmethod
+    def setUpTestDataWithPdns(cls):
+        super().setUpTestDataWithPdns()
+        cls.domain = cls.create_domain()
+
+    def test_session_reused(self):
+        self.assertIs(pdns._session(pdns.NSLORD), pdns._session(pdns.NSLORD))
+        self.assertIsNot(pdns._session(pdns.NSLORD), pdns._session(pdns.NSMASTER))
+
+    def test_pool_metrics(self):
+        def sample(name):
+            return REGISTRY.get_sample_value(f'desecapi_pdns_pool_{name}_total', {'server': 'nslord'}) or 0
+
+        requests = sample('requests')
+        for i in range(3):
+            with self.assertPdnsRequests(self.request_pdns_zone_retrieve_crypto_keys(name=self.domain.name)):
+                pdns._pdns_get(pdns.NSLORD, '/zones/%s/cryptokeys' % pdns.pdns_id(self.domain.name))
+            self.assertEqual(sample('requests'), requests + i + 1)
+
+    def test_mark_dead_processes(self):
+        with TemporaryDirectory() as path, mock.patch.dict(os.environ, {'prometheus_multiproc_dir': path}), \
+                self.settings(METRICS_PROCESS_PREFIX='celery-host-'):
+            alive = os.path.join(path, f'gauge_livesum_celery-host-{os.getpid()}.db')
+            dead = os.path.join(path, 'gauge_livesum_celery-host-999999999.db')
+            other = os.path.join(path, 'gauge_livesum_celery-other-999999999.db')
+            counter = os.path.join(path, 'counter_celery-host-999999999.db')
+            for filename in [alive, dead, other, counter]:
+                open(filename, 'w').close()
+            metrics.mark_dead_processes()
+            self.assertCountEqual(os.listdir(path), map(os.path.basename, [alive, other, counter]))
+            metrics.mark_process_dead()
+            self.assertCountEqual(os.listdir(path), map(os.path.basename, [other, counter]))
+
+    def test_keys_cached(self):
+        with self.assertPdnsRequests(self.request_pdns_zone_retrieve_crypto_keys(name=self.domain.name)):
+            keys = pdns.get_keys(self.domain)
+        with self.assertPdnsRequests():
+            self.assertEqual(pdns.get_keys(self.domain), keys)
+
+        pdns.invalidate_keys(self.domain.name)
+        with self.assertPdnsRequests(self.request_pdns_zone_retrieve_crypto_keys(name=self.domain.name)):
+            self.assertEqual(pdns.get_keys(self.domain), keys)
+
+        call_command('invalidate-keys', self.domain.name, stdout=StringIO())
+        with self.assertPdnsRequests(self.request_pdns_zone_retrieve_crypto_keys(name=self.domain.name)):
+            self.assertEqual(pdns.get_keys(self.domain), keys)
+
+        with self.assertRaises(CommandError):
+            call_command('invalidate-keys', 'unknown.test', stdout=StringIO())
+
+    def test_axfr_retrieve_coalesced(self):
+        name = self.domain.name
+        changed = time.time()
+        with self.assertPdnsRequests(self.request_pdns_zone_axfr(name)):
+            self.assertTrue(pdns.axfr_retrieve(name, changed))
+        with self.assertPdnsRequests():  # the previous request was sent after the change
+            self.assertFalse(pdns.axfr_retrieve(name, changed))
+        with self.assertPdnsRequests(self.request_pdns_zone_axfr(name)):
+            self.assertTrue(pdns.axfr_retrieve(name, time.time()))
+
+    def test_axfr_retrieve_failed(self):
+        name = self.domain.name
+        changed = time.time()
+        request = self.request_pdns_zone_axfr(name)
+        request['status'] = 500
+        with self.assertPdnsNoRequestsBut(request), self.assertRaises(PDNSException):
+            pdns.axfr_retrieve(name, changed)
+        with self.assertPdnsRequests(self.request_pdns_zone_axfr(name)):  # not coalesced with the failed request
+            self.assertTrue(pdns.axfr_retrieve(name, changed))
+
+    def test_get_retried(self):
+        request = self.request_pdns_zone_retrieve_crypto_keys(name=self.domain.name)
+        request['responses'] = [
+            httpretty.Response(body='', status=503),
+            httpretty.Response(body=request.pop('body'), status=request.pop('status')),
+        ]
+        with self.assertPdnsNoRequestsBut(request):
+            self.assertTrue(pdns.get_keys(self.domain))
+            self.assertEqual(len(httpretty.latest_requests), 2)
+
+    def test_patch_not_retried(self):
+        request = self.request_pdns_zone_update(name=self.domain.name)
+        request['status'] = 503
+        with self.assertPdnsNoRequestsBut(request):
+            with self.assertRaises(PDNSException):
+                pdns._pdns_patch(pdns.NSLORD, '/zones/' + pdns.pdns_id(self.domain.name), {'rrsets': []})
+            self.assertEqual(len(httpretty.latest_requests), 1)
+
+    def test_endpoint(self):
+        for path, endpoint in [
+            ('/zones', 'zones'),
+            ('/zones?rrsets=false', 'zones'),
+            ('/zones/example.com.', 'zones/{id}'),
+            ('/zones/example.com./cryptokeys', 'zones/{id}/cryptokeys'),
+            ('/zones/example.com./cryptokeys/3', 'zones/{id}/cryptokeys/{id}'),
+            ('/zones/example.com./axfr-retrieve', 'zones/{id}/axfr-retrieve'),
+        ]:
+            self.assertEqual(pdns._endpoint(path), endpoint)
+
+    def test_metrics(self):
+        labels = {'server': 'nslord', 'method': 'get', 'endpoint': 'zones/{id}/cryptokeys'}
+
+        def sample(name, **kwargs):
+            return REGISTRY.get_sample_value(name, {**labels, **kwargs}) or 0
+
+        count = sample('desecapi_pdns_request_duration_count')
+        failures = sample('desecapi_pdns_request_failure_total', status='500')
+
+        request = self.request_pdns_zone_retrieve_crypto_keys(name=self.domain.name)
+        with pdns.track_request_stats() as stats:
+            with self.assertPdnsRequests(request):
+                pdns.get_keys(self.domain)
+            request['status'] = 500
+            with self.assertPdnsRequests(request):
+                with self.assertRaises(PDNSException):
+                    pdns._pdns_get(pdns.NSLORD, '/zones/%s/cryptokeys' % pdns.pdns_id(self.domain.name))
+
+        self.assertEqual(sample('desecapi_pdns_request_duration_count'), count + 2)
+        self.assertEqual(sample('desecapi_pdns_request_failure_total', status='500'), failures + 1)
+        self.assertEqual(REGISTRY.get_sample_value('desecapi_pdns_requests_in_progress', {'server': 'nslord'}), 0)
+        self.assertEqual(stats.count, 2)
+        self.assertGreater(stats.duration, 0)
+
+    def test_view_metrics(self):
+        labels = {'view': 'v1:domain-detail'}
+        count = REGISTRY.get_sample_value('desecapi_view_pdns_requests_sum', labels) or 0
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.create_token(user=self.domain.owner).plain)
+        with self.assertPdnsRequests(self.request_pdns_zone_retrieve_crypto_keys(name=self.domain.name)):
+            self.client.get(self.reverse('v1:domain-detail', name=self.domain.name))
+        self.assertEqual(REGISTRY.get_sample_value('desecapi_view_pdns_requests_sum', labels), count + 1)
+
+
+class EncodeRRsetsChunkedTestCase(SimpleTestCase):
+    RRSETS = [
+        {'name': f'{i}.example.com.', 'type': 'A', 'ttl': 3600, 'changetype': 'REPLACE',
+         'records': [{'content': f'1.2.3.{i}', 'disabled': False}]}
+        for i in range(100)
+    ]
+
+    def test_empty(self):
+        self.assertEqual(list(pdns.encode_rrsets_chunked([])), [])
+
+    def test_single_chunk(self):
+        chunks = list(pdns.encode_rrsets_chunked(self.RRSETS, max_size=1024 * 1024))
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(json.loads(chunks[0][0]), {'rrsets': self.RRSETS})
+        self.assertEqual(chunks[0][1], len(self.RRSETS))
+
+    def test_multiple_chunks(self):
+        max_size = 1000
+        chunks = list(pdns.encode_rrsets_chunked(self.RRSETS, max_size=max_size))
+        self.assertGreater(len(chunks), 1)
+        rrsets = []
+        for body, count in chunks:
+            self.assertLessEqual(len(body), max_size)
+            self.assertEqual(len(json.loads(body)['rrsets']), count)
+            rrsets += json.loads(body)['rrsets']
+        self.assertEqual(rrsets, self.RRSETS)
+
+    def test_rrset_too_large(self):
+        with self.assertRaises(RequestEntityTooLarge):
+            list(pdns.encode_rrsets_chunked(self.RRSETS, max_size=50))
@@ -1,6 +1,20 @@
+import json
+import threading
+import time
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import override_settings
 from django.utils import timezone
+from httpretty import httpretty
+from prometheus_client import REGISTRY
 
-from desecapi.models import RRset, RR, Domain
+from desecapi import replication
+from desecapi.exceptions import PDNSException, PDNSPartialUpdateException
+from desecapi.models import RRset, RR, RRsetOutbox, Domain, ZoneChange
+from desecapi.pdns import NSLORD, NSMASTER
 from desecapi.pdns_change_tracker import PDNSChangeTracker
 from desecapi.tests.base import DesecTestCase
 
@@ -363,6 +377,76 @@ class RRSetTestCase(PdnsChangeTrackerTestCase):
                 rr_set.ttl = new_ttl
                 rr_set.save()
 
+    @override_settings(PDNS_MAX_BODY_SIZE=700)
+    def test_empty_domain_create_chunked(self):
+        with self.assertPdnsRequests(
+                self.request_pdns_zone_update(self.empty_domain.name),
+                self.request_pdns_zone_update(self.empty_domain.name),
+                self.request_pdns_zone_axfr(self.empty_domain.name),
+        ), PDNSChangeTracker():
+            self._create_rr_sets(self.ADDITIONAL_TEST_DATA, self.empty_domain)
+
+    @override_settings(PDNS_MAX_BODY_SIZE=700)
+    def test_empty_domain_create_chunked_partial_failure(self):
+        request = self.request_pdns_zone_update(self.empty_domain.name)
+        request['responses'] = [httpretty.Response(body='', status=200), httpretty.Response(body='', status=500)]
+        failures = REGISTRY.get_sample_value('desecapi_pdns_reconciliations_total', {'result': 'failure'}) or 0
+        with self.assertPdnsNoRequestsBut(request):
+            with self.assertRaises(ValueError) as cm, PDNSChangeTracker():
+                self._create_rr_sets(self.ADDITIONAL_TEST_DATA, self.empty_domain)
+            # the applied chunk could not be reverted either, so the RRsets are left in the outbox
+            self.assertEqual(len(httpretty.latest_requests), 3)
+        self.assertIsInstance(cm.exception.__cause__, PDNSPartialUpdateException)
+        self.assertEqual(cm.exception.__cause__.applied, 1)
+        self.assertEqual(cm.exception.__cause__.total, 2)
+        self.assertEqual(
+            set(RRsetOutbox.objects.filter(domain_name=self.empty_domain.name).values_list('type', 'subname')),
+            {(type_, subname) for type_, subname, _ in self.ADDITIONAL_TEST_DATA.keys()},
+        )
+        self.assertEqual(REGISTRY.get_sample_value('desecapi_pdns_reconciliations_total', {'result': 'failure'}),
+                         failures + 1)
+
+    @override_settings(PDNS_MAX_BODY_SIZE=700)
+    def test_empty_domain_create_chunked_partial_failure_reverted(self):
+        request = self.request_pdns_zone_update(self.empty_domain.name)
+        request['responses'] = [httpretty.Response(body='', status=200), httpretty.Response(body='', status=500),
+                                httpretty.Response(body='', status=200)]
+        with self.assertPdnsNoRequestsBut(request, self.request_pdns_zone_axfr(self.empty_domain.name)):
+            with self.assertRaises(ValueError), PDNSChangeTracker():
+                self._create_rr_sets(self.ADDITIONAL_TEST_DATA, self.empty_domain)
+            self.assertEqual(len(httpretty.latest_requests), 4)
+            # the database state (i.e. no RRsets) was sent again
+            body = json.loads(httpretty.latest_requests[2].body)
+            self.assertTrue(body['rrsets'])
+            self.assertTrue(all(rrset['records'] == [] for rrset in body['rrsets']))
+        self.assertFalse(RRsetOutbox.objects.filter(domain_name=self.empty_domain.name).exists())
+
+    def test_prepare_num_queries(self):
+        data = {('A', f'host{i}', 3600 + i): [f'10.0.{i // 256}.{i % 256}', '10.1.0.1'] for i in range(500)}
+        self._create_rr_sets(data, self.empty_domain)
+        additions = {(type_, subname) for type_, subname, _ in data.keys()}
+        change = PDNSChangeTracker.CreateUpdateDeleteRRSets(self.empty_domain.name, additions, set(), {('A', 'gone')})
+        with self.assertNumQueries(2):
+            change.pdns_prepare()
+        rrsets = {(rrset['type'], rrset['name']): rrset for rrset in change._rrsets}
+        self.assertEqual(len(rrsets), len(data) + 1)
+        self.assertEqual(rrsets['A', f'gone.{self.empty_domain.name}.']['records'], [])
+        for (type_, subname, ttl), contents in data.items():
+            rrset = rrsets[type_, f'{subname}.{self.empty_domain.name}.']
+            self.assertEqual(rrset['ttl'], ttl)
+            self.assertCountEqual([record['content'] for record in rrset['records']], contents)
+
+    def test_compute_changes_num_queries(self):
+        data = {('A', f'host{i}', 3600): [f'10.0.{i // 256}.{i % 256}'] if i % 2 else [] for i in range(500)}
+        self._create_rr_sets(data, self.empty_domain)
+        tracker = PDNSChangeTracker()
+        tracker._rr_set_additions = {self.empty_domain.name: {(type_, subname) for type_, subname, _ in data.keys()}}
+        with self.assertNumQueries(1):
+            changes = tracker._compute_changes()
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0]._additions,
+                         {(type_, subname) for (type_, subname, _), records in data.items() if records})
+
     def test_full_domain_create_delete(self):
         data = self.TEST_DATA
         empty_data = {key: [] for key, value in data.items()}
@@ -493,6 +577,24 @@ class DomainTestCase(PdnsChangeTrackerTestCase):
             self.empty_domain.name = new_name
             self.empty_domain.save()
 
+    def test_zone_changes_recorded(self):
+        name = self.random_domain_name()
+        with self.assertPdnsRequests(self.requests_desec_domain_creation(name)[:-1]), PDNSChangeTracker():
+            domain = Domain.objects.create(name=name, owner=self.user)
+        with self.assertPdnsRequests(self.requests_desec_domain_deletion(domain)), PDNSChangeTracker():
+            domain.delete()
+        self.assertEqual(list(ZoneChange.objects.filter(name=name).values_list('name', flat=True)), [name, name])
+
+    def test_create_delete_invalidates_keys(self):
+        name = self.random_domain_name()
+        with mock.patch('desecapi.pdns_change_tracker.invalidate_keys') as invalidate_keys:
+            with self.assertPdnsRequests(self.requests_desec_domain_creation(name)[:-1]), PDNSChangeTracker():
+                domain = Domain.objects.create(name=name, owner=self.user)
+            invalidate_keys.assert_called_once_with(name)
+            with self.assertPdnsRequests(self.requests_desec_domain_deletion(domain)), PDNSChangeTracker():
+                domain.delete()
+            self.assertEqual(invalidate_keys.call_count, 2)
+
     def test_delete_single(self):
         for domain in self.domains:
             with self.assertPdnsRequests(self.requests_desec_domain_deletion(domain)), PDNSChangeTracker():
@@ -505,6 +607,71 @@ class DomainTestCase(PdnsChangeTrackerTestCase):
             for domain in self.domains:
                 domain.delete()
 
+    # httpretty is not thread-safe, so in concurrent mode, we look at the calls to the pdns module instead
+    @override_settings(PDNS_CONCURRENCY=3)
+    def test_delete_multiple_concurrently(self):
+        with mock.patch('desecapi.pdns_change_tracker._pdns_delete') as pdns_delete, \
+                mock.patch('desecapi.pdns_change_tracker._pdns_patch') as pdns_patch, PDNSChangeTracker():
+            for domain in self.domains:
+                domain.delete()
+        self.assertCountEqual(pdns_delete.call_args_list, [
+            mock.call(ns, f'/zones/{domain.name}.') for domain in self.domains for ns in [NSLORD, NSMASTER]
+        ])
+        self.assertEqual(pdns_patch.call_count, len(self.domains))  # catalog zone updates
+
+    @override_settings(PDNS_CONCURRENCY=3)
+    def test_update_multiple_concurrently(self):
+        with mock.patch('desecapi.pdns_change_tracker._pdns_patch') as pdns_patch, \
+                mock.patch('desecapi.pdns._pdns_put') as pdns_put, PDNSChangeTracker():
+            for domain in self.domains:
+                RRset.objects.create(domain=domain, type='TXT', subname='concurrent', ttl=3600, contents=['"x"'])
+        self.assertCountEqual(
+            [(path, [rrset['name'] for rrset in json.loads(body)['rrsets']])
+             for (_, path, body), _ in pdns_patch.call_args_list],
+            [(f'/zones/{domain.name}.', [f'concurrent.{domain.name}.']) for domain in self.domains],
+        )
+        self.assertCountEqual(pdns_put.call_args_list, [
+            mock.call(NSMASTER, f'/zones/{domain.name}./axfr-retrieve') for domain in self.domains
+        ])
+        replication.update.apply_async.assert_has_calls(
+            [mock.call((domain.name,), countdown=0) for domain in self.domains],
+            any_order=True)
+
+    @override_settings(PDNS_CONCURRENCY=3)
+    def test_failure_concurrently(self):
+        name = self.random_domain_name()
+        with mock.patch('desecapi.pdns_change_tracker._pdns_patch') as pdns_patch, \
+                mock.patch('desecapi.pdns_change_tracker._pdns_post', side_effect=PDNSException()), \
+                mock.patch('desecapi.pdns._pdns_put') as pdns_put:
+            with self.assertRaises(ValueError), PDNSChangeTracker():
+                RRset.objects.create(domain=self.simple_domain, type='TXT', subname='x', ttl=3600, contents=['"x"'])
+                Domain.objects.create(name=name, owner=self.user)
+        self.assertLessEqual(pdns_patch.call_count, 1)  # other zones' changes are sent only if already started
+        pdns_put.assert_not_called()
+        self.assertFalse(Domain.objects.filter(name=name).exists())
+        self.assertFalse(RRset.objects.filter(domain=self.simple_domain, subname='x').exists())
+
+    @override_settings(PDNS_CONCURRENCY=2)
+    def test_failure_concurrently_stops(self):
+        names = [self.random_domain_name() for _ in range(4)]
+        started = threading.Barrier(2)
+
+        def patch(server, path, data):
+            if started.wait(timeout=5) == 0:  # the first two zones are in flight at the same time, one of them fails
+                raise PDNSException()
+            time.sleep(.2)
+
+        for name in names:
+            Domain.objects.create(name=name, owner=self.user)
+        with mock.patch('desecapi.pdns_change_tracker._pdns_patch', side_effect=patch) as pdns_patch, \
+                mock.patch('desecapi.pdns._pdns_put'):
+            with self.assertRaises(ValueError), PDNSChangeTracker():
+                for name in names:
+                    RRset.objects.create(domain=Domain.objects.get(name=name), type='TXT', subname='x', ttl=3600,
+                                         contents=['"x"'])
+        # the other zones had not started when the change failed
+        self.assertEqual(pdns_patch.call_count, 2)
+
     def test_create_delete(self):
         with PDNSChangeTracker():
             d = Domain.objects.create(name=self.random_domain_name(), owner=self.user)
@@ -521,3 +688,110 @@ class DomainTestCase(PdnsChangeTrackerTestCase):
         with self.assertPdnsZoneUpdate(name, []), PDNSChangeTracker():
             self.full_domain.delete()
             self.full_domain = Domain.objects.create(name=name, owner=self.user)
+
+
+@override_settings(PDNS_WRITE_BEHIND=True)
+class WriteBehindTestCase(PdnsChangeTrackerTestCase):
+
+    def test_rrset_does_not_exist_exception(self):
+        # RRsets are not read before flushing, where RRsets that do not exist are deleted
+        tracker = PDNSChangeTracker()
+        tracker.__enter__()
+        tracker._rr_set_updated(RRset(domain=self.empty_domain, subname='', type='A'))
+        tracker.__exit__(None, None, None)
+        with self.assertPdnsZoneUpdate(self.empty_domain.name, {('A', '', 3600): []}):
+            PDNSChangeTracker.flush(self.empty_domain.name)
+
+    def test_rrset_changes_queued(self):
+        published = Domain.objects.get(pk=self.simple_domain.pk).published
+        with self.assertPdnsRequests(), PDNSChangeTracker():
+            RRset.objects.create(domain=self.simple_domain, subname='a', ttl=3600, type='A').records.create(
+                content='1.2.3.4')
+        with self.assertPdnsRequests(), PDNSChangeTracker():
+            RRset.objects.create(domain=self.simple_domain, subname='b', ttl=3600, type='A').records.create(
+                content='1.2.3.5')
+            RRset.objects.get(domain=self.simple_domain, subname='a', type='A').records.create(content='1.2.3.6')
+        self.assertEqual(RRsetOutbox.objects.filter(domain_name=self.simple_domain.name).count(), 3)
+        self.assertEqual(Domain.objects.get(pk=self.simple_domain.pk).published, published)
+
+        # All changes are sent in one update
+        data = {('A', 'a', 3600): ['1.2.3.4', '1.2.3.6'], ('A', 'b', 3600): ['1.2.3.5']}
+        with self.assertPdnsZoneUpdate(self.simple_domain.name, data):
+            self.assertEqual(PDNSChangeTracker.flush(self.simple_domain.name), 3)
+        self.assertFalse(RRsetOutbox.objects.exists())
+        self.assertNotEqual(Domain.objects.get(pk=self.simple_domain.pk).published, published)
+
+        with self.assertPdnsRequests():
+            self.assertEqual(PDNSChangeTracker.flush(self.simple_domain.name), 0)
+
+    def test_rrset_deletion_queued(self):
+        with PDNSChangeTracker():
+            RRset.objects.create(domain=self.simple_domain, subname='a', ttl=3600, type='A').records.create(
+                content='1.2.3.4')
+        with self.assertPdnsRequests(), PDNSChangeTracker():
+            RRset.objects.get(domain=self.simple_domain, subname='a', type='A').delete()
+        with self.assertPdnsZoneUpdate(self.simple_domain.name, {('A', 'a', 3600): []}):
+            PDNSChangeTracker.flush(self.simple_domain.name)
+
+    def test_domain_changes_not_queued(self):
+        name = self.random_domain_name()
+        with self.assertPdnsRequests(self.requests_desec_domain_creation(name)[:-1]), PDNSChangeTracker():
+            Domain.objects.create(name=name, owner=self.user)
+        self.assertFalse(RRsetOutbox.objects.exists())
+
+    def test_flush_deleted_domain(self):
+        with PDNSChangeTracker():
+            RRset.objects.create(domain=self.simple_domain, subname='a', ttl=3600, type='A').records.create(
+                content='1.2.3.4')
+        with self.assertPdnsRequests(self.requests_desec_domain_deletion(self.simple_domain)), PDNSChangeTracker():
+            self.simple_domain.delete()
+        with self.assertPdnsRequests():
+            self.assertEqual(PDNSChangeTracker.flush(self.simple_domain.name), 1)
+        self.assertFalse(RRsetOutbox.objects.exists())
+
+    def test_flush_failure(self):
+        with PDNSChangeTracker():
+            RRset.objects.create(domain=self.simple_domain, subname='a', ttl=3600, type='A').records.create(
+                content='1.2.3.4')
+        request = self.request_pdns_zone_update(self.simple_domain.name)
+        request['status'] = 500
+        with self.assertPdnsRequests(request):
+            with self.assertRaises(PDNSException):
+                PDNSChangeTracker.flush(self.simple_domain.name)
+        self.assertEqual(RRsetOutbox.objects.count(), 1)
+
+    def test_flush_keeps_entries_added_meanwhile(self):
+        with PDNSChangeTracker():
+            RRset.objects.create(domain=self.simple_domain, subname='a', ttl=3600, type='A').records.create(
+                content='1.2.3.4')
+        pdns_do = PDNSChangeTracker.CreateUpdateDeleteRRSets.pdns_do
+
+        def pdns_do_concurrent_change(change):
+            RRsetOutbox.objects.create(domain_name=self.simple_domain.name, type='A', subname='b')
+            pdns_do(change)
+
+        with mock.patch.object(PDNSChangeTracker.CreateUpdateDeleteRRSets, 'pdns_do', pdns_do_concurrent_change), \
+                self.assertPdnsZoneUpdate(self.simple_domain.name, {('A', 'a', 3600): ['1.2.3.4']}):
+            self.assertEqual(PDNSChangeTracker.flush(self.simple_domain.name), 1)
+        self.assertEqual(list(RRsetOutbox.objects.values_list('subname', flat=True)), ['b'])
+
+    def test_flush_command(self):
+        with PDNSChangeTracker():
+            for domain in [self.simple_domain, self.full_domain]:
+                RRset.objects.create(domain=domain, subname='a', ttl=3600, type='A').records.create(content='1.2.3.4')
+        with self.assertPdnsRequests(
+                [self.request_pdns_zone_update(domain.name) for domain in [self.simple_domain, self.full_domain]],
+                [self.request_pdns_zone_axfr(domain.name) for domain in [self.simple_domain, self.full_domain]],
+                expect_order=False,
+        ):
+            call_command('flush-pdns-outbox', stdout=StringIO())
+        self.assertFalse(RRsetOutbox.objects.exists())
+
+    def test_flush_command_loop_interval(self):
+        for write_behind, interval in [(True, settings.PDNS_WRITE_BEHIND_WINDOW / 2),
+                                       (False, settings.PDNS_OUTBOX_RETRY_INTERVAL)]:
+            with self.settings(PDNS_WRITE_BEHIND=write_behind), \
+                    mock.patch('time.sleep', side_effect=KeyboardInterrupt) as sleep:
+                with self.assertRaises(KeyboardInterrupt):
+                    call_command('flush-pdns-outbox', '--loop', stdout=StringIO())
+                sleep.assert_called_once_with(interval)
@@ -0,0 +1,73 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+import psl_dns
+from django.core.cache import cache
+from django.test import override_settings, TestCase
+from prometheus_client import REGISTRY
+
+from desecapi.psl import PSL, Snapshot
+
+
+class SnapshotTestCase(TestCase):
+    RULES = [
+        '// ===BEGIN ICANN DOMAINS===', '', 'com', 'uk', 'co.uk', 'ck', '*.ck', '!www.ck', 'cn', '公司.cn',
+        'dedyn.io  // everything after whitespace is ignored',
+    ]
+
+    def test_get_public_suffix(self):
+        snapshot = Snapshot(self.RULES)
+        for domain, public_suffix in {
+            'com': 'com',
+            'example.com': 'com',
+            'a.example.co.uk': 'co.uk',
+            'Example.CO.uk': 'co.uk',
+            'example.ck': 'example.ck',  # wildcard
+            'a.example.ck': 'example.ck',
+            'www.ck': 'ck',  # exception
+            'a.www.ck': 'ck',
+            'example.公司.cn': '公司.cn',
+            'example.xn--55qx5d.cn': 'xn--55qx5d.cn',
+            'foo.dedyn.io': 'dedyn.io',
+            'example.unknown': 'unknown',  # implicit rule "*"
+        }.items():
+            self.assertEqual(snapshot.get_public_suffix(domain), public_suffix, domain)
+
+
+class PSLTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.psl = PSL()
+
+    @staticmethod
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    @override_settings(PSL_SNAPSHOT_PATH=None)
+    def test_cache(self):
+        hits = self.sample('desecapi_psl_cache_hit_total')
+        with mock.patch.object(psl_dns.PSL, 'get_public_suffix', return_value='co.uk') as resolver:
+            for _ in range(3):
+                self.assertEqual(self.psl.get_public_suffix('example.co.uk'), 'co.uk')
+                self.assertFalse(self.psl.is_public_suffix('example.co.uk'))
+        resolver.assert_called_once_with('example.co.uk')
+        self.assertEqual(self.sample('desecapi_psl_cache_hit_total'), hits + 5)
+
+    def test_snapshot(self):
+        with TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'public_suffix_list.dat')
+            with open(path, 'w') as f:
+                f.write('uk\n')
+            with override_settings(PSL_SNAPSHOT_PATH=path), \
+                    mock.patch.object(psl_dns.PSL, 'get_public_suffix') as resolver:
+                self.assertEqual(self.psl.get_public_suffix('example.co.uk'), 'uk')
+
+                # a replaced snapshot is read again
+                with open(path, 'w') as f:
+                    f.write('uk\nco.uk\n')
+                os.utime(path, ns=(0, 0))
+                cache.clear()
+                self.assertEqual(self.psl.get_public_suffix('example.co.uk'), 'co.uk')
+            resolver.assert_not_called()
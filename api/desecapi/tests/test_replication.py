@@ -1,15 +1,33 @@
+import fcntl
+import hashlib
 import json
 import os
 import random
 import string
+import threading
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 from tempfile import TemporaryDirectory
+from unittest import mock
 
-from django.test import testcases
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+import dns.zone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test import override_settings, testcases
+from django.utils import timezone
+from prometheus_client import REGISTRY
 from rest_framework import status
 
-from desecapi.replication import Repository
+from desecapi import replication
+from desecapi.metrics import ReplicationCollector
+from desecapi.models import Domain, ZoneChange
+from desecapi.replication import GIT_BACKENDS, Repository, ZoneFileWriter, ZoneRepository
 from desecapi.tests.base import DesecTestCase
 
 
@@ -41,6 +59,272 @@ class ReplicationTest(DesecTestCase):
             # Do not expect pdns request in next iteration (result will be cached)
             pdns_requests = []
 
+    def test_update_debounced(self):
+        name = self.random_domain_name()
+        replication.schedule_update(name)
+        replication.schedule_update(name)
+        replication.update.apply_async.assert_called_once_with((name,), countdown=0)
+
+        # Once replication has started, further changes need another run, which waits for the debounce interval
+        with mock.patch('desecapi.replication.ZoneRepository') as repository, \
+                mock.patch('desecapi.replication.commit.apply_async'):
+            repository.return_value.add_pending.return_value = 1
+            replication.update(name)
+        replication.schedule_update(name)
+        self.assertEqual(replication.update.apply_async.call_count, 2)
+        countdown = replication.update.apply_async.call_args[1]['countdown']
+        self.assertTrue(0 < countdown <= settings.REPLICATION_DEBOUNCE)
+
+        # If queuing fails, the next change tries again
+        name = self.random_domain_name()
+        replication.update.apply_async.side_effect = ConnectionError
+        with self.assertRaises(ConnectionError):
+            replication.schedule_update(name)
+        replication.update.apply_async.side_effect = None
+        replication.schedule_update(name)
+        replication.update.apply_async.assert_called_with((name,), countdown=0)
+
+    @mock.patch('desecapi.replication.commit.apply_async')
+    @mock.patch('desecapi.replication.ZoneRepository')
+    def test_update_unchanged(self, repository, commit_apply_async):
+        repository.return_value.refresh.return_value = False
+        unchanged = REGISTRY.get_sample_value('desecapi_replication_unchanged_total') or 0
+        replication.update(self.random_domain_name())
+        repository.return_value.add_pending.assert_not_called()
+        commit_apply_async.assert_not_called()
+        self.assertEqual(REGISTRY.get_sample_value('desecapi_replication_unchanged_total'), unchanged + 1)
+
+    @override_settings(REPLICATION_COMMIT_MAX_ZONES=50)
+    @mock.patch('desecapi.replication.commit.apply_async')
+    @mock.patch('desecapi.replication.ZoneRepository')
+    def test_commit_batched(self, repository, commit_apply_async):
+        repository.return_value.add_pending.side_effect = range(1, settings.REPLICATION_COMMIT_MAX_ZONES + 1)
+        for _ in range(settings.REPLICATION_COMMIT_MAX_ZONES - 1):
+            replication.update(self.random_domain_name())
+        commit_apply_async.assert_called_once_with(countdown=settings.REPLICATION_COMMIT_WINDOW, priority=9)
+        repository.return_value.commit_pending.assert_not_called()
+
+        # size bound reached
+        replication.update(self.random_domain_name())
+        repository.return_value.commit_pending.assert_called_once_with()
+
+        # once the commit has started, further updates need another commit
+        replication.commit()
+        replication.schedule_commit()
+        self.assertEqual(commit_apply_async.call_count, 2)
+
+    @mock.patch('desecapi.replication.commit.apply_async')
+    @mock.patch('desecapi.replication.ZoneRepository')
+    def test_replicated_on_commit(self, repository, commit_apply_async):
+        domain = self.create_domain()
+        repository.return_value.add_pending.return_value = 1
+        replication.update(domain.name)
+        domain.refresh_from_db()
+        self.assertIsNone(domain.replicated)  # pending commit
+        self.assertIsNotNone(domain.replication_duration)
+
+        repository.return_value.commit_pending.return_value = [domain.name]
+        replication.commit()
+        domain.refresh_from_db()
+        self.assertIsNotNone(domain.replicated)
+
+        # unchanged, but still pending from a previous update
+        domain.replicated = None
+        domain.save()
+        repository.return_value.refresh.return_value = False
+        repository.return_value.is_pending.return_value = True
+        replication.update(domain.name)
+        domain.refresh_from_db()
+        self.assertIsNone(domain.replicated)
+        repository.return_value.is_pending.return_value = False
+        replication.update(domain.name)
+        domain.refresh_from_db()
+        self.assertIsNotNone(domain.replicated)
+
+    @mock.patch('desecapi.replication.commit.apply_async')
+    @mock.patch('desecapi.replication.ZoneRepository')
+    def test_commit_failed(self, repository, commit_apply_async):
+        repository.return_value.commit_pending.side_effect = replication.GitRepositoryException('failed')
+        with self.assertRaises(replication.GitRepositoryException):
+            replication.commit()
+        commit_apply_async.assert_called_once_with(countdown=settings.REPLICATION_COMMIT_WINDOW, priority=9)
+
+    def request_pdns_serials(self, serials):
+        return {
+            'method': 'GET',
+            'uri': self.get_full_pdns_url(r'/zones', ns='MASTER'),
+            'status': 200,
+            'body': json.dumps([{'name': name, 'edited_serial': serial} for name, serial in serials.items()]),
+        }
+
+    def get_serials(self, serials=None, **kwargs):
+        """
+        Requests the serial list. If serials are given, the cached list is expired, and pdns returns these serials.
+        """
+        if serials is not None:
+            cache.delete('desecapi.views.serials')
+        with self.assertPdnsRequests(self.request_pdns_serials(serials) if serials is not None else []):
+            return self.client.get(path=self.reverse('v1:serial'), REMOTE_ADDR='10.8.0.2', **kwargs)
+
+    def request_pdns_zone_serial(self, name, serial):
+        # httpretty matches GET requests without query string, while assertPdnsRequests() checks it
+        return {
+            'method': 'GET',
+            'uri': self.get_full_pdns_url(self.PDNS_ZONE + r'(\?rrsets=false)?', ns='MASTER',
+                                          id=self._pdns_zone_id_heuristic(name)),
+            'status': 200 if serial else 404,
+            'body': json.dumps({'name': name + '.', 'edited_serial': serial} if serial else {'error': 'Not Found'}),
+        }
+
+    def test_serials_delta(self):
+        past = timezone.now() - timedelta(minutes=5)
+        changes = [ZoneChange.objects.create(name=name) for name in ['a.example', 'b.example', 'a.example']]
+        ZoneChange.objects.update(created=past)
+
+        # Full list announces the cursor
+        response = self.get_serials({'a.example.': 2})
+        self.assertStatus(response, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'a.example.': 2})
+        self.assertEqual(response['X-Serials-Cursor'], str(changes[-1].id))
+        full_etag = response['ETag']
+        self.assertStatus(self.get_serials(HTTP_IF_NONE_MATCH=full_etag), status.HTTP_304_NOT_MODIFIED)
+
+        # Delta since before the first change (taken from the cached full list), b.example was deleted meanwhile
+        since = changes[0].id - 1
+        response = self.get_serials(data={'since': since})
+        self.assertStatus(response, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'a.example.': 2, 'b.example.': None})
+        self.assertEqual(response['X-Serials-Cursor'], str(changes[-1].id))
+
+        # Unchanged
+        etag = response['ETag']
+        self.assertStatus(self.get_serials(data={'since': since}, HTTP_IF_NONE_MATCH=etag),
+                          status.HTTP_304_NOT_MODIFIED)
+        response = self.get_serials(data={'since': changes[-1].id})
+        self.assertStatus(response, status.HTTP_200_OK)
+        self.assertEqual(response.data, {})
+
+        # A recent change is reported, but the cursor does not advance until it has settled
+        ZoneChange.objects.create(name='c.example')
+        response = self.get_serials(data={'since': changes[-1].id})
+        self.assertStatus(response, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'c.example.': None})  # not yet in the cached list
+        self.assertEqual(response['X-Serials-Cursor'], str(changes[-1].id))
+
+        # Without cached full list, only the changed zones are looked up (and cached), and the ETag follows the serials
+        etag = response['ETag']
+        cache.delete('desecapi.views.serials')
+        with self.assertPdnsRequests(self.request_pdns_zone_serial('c.example', 3)):
+            response = self.client.get(path=self.reverse('v1:serial'), data={'since': changes[-1].id},
+                                       REMOTE_ADDR='10.8.0.2', HTTP_IF_NONE_MATCH=etag)
+        self.assertStatus(response, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'c.example.': 3})
+        self.assertStatus(self.get_serials(data={'since': changes[-1].id}, HTTP_IF_NONE_MATCH=response['ETag']),
+                          status.HTTP_304_NOT_MODIFIED)
+
+        # Deltas needing too many lookups are refused
+        with override_settings(SERIALS_DELTA_LOOKUP_LIMIT=1):
+            self.assertStatus(self.get_serials(data={'since': since}), status.HTTP_410_GONE)
+
+        # Expired cursor
+        ZoneChange.objects.filter(id__lte=changes[0].id).delete()
+        self.assertStatus(self.get_serials(data={'since': since}), status.HTTP_410_GONE)
+        self.assertStatus(self.get_serials(data={'since': 'foo'}), status.HTTP_400_BAD_REQUEST)
+
+    def test_serials_untracked_change(self):
+        since = ZoneChange.objects.create(name='a.example').id
+        self.get_serials({'a.example.': 1, 'b.example.': 1})
+        self.assertStatus(self.get_serials(data={'since': since}), status.HTTP_200_OK)
+        full_etag = self.get_serials()['ETag']
+
+        # e.g. weekly serial increment on nslord, which does not go through the change tracker
+        response = self.get_serials({'a.example.': 2, 'b.example.': 1}, HTTP_IF_NONE_MATCH=full_etag)
+        self.assertStatus(response, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'a.example.': 2, 'b.example.': 1})
+        response = self.get_serials(data={'since': since})
+        self.assertEqual(response.data, {'a.example.': 2})
+
+    def test_rotation_cycle_start(self):
+        for now, start in [
+            ('2021-06-10T00:00:00+00:00', '2021-06-10T00:00:00+00:00'),  # Thursday
+            ('2021-06-10T12:34:56+00:00', '2021-06-10T00:00:00+00:00'),
+            ('2021-06-09T23:59:59+00:00', '2021-06-03T00:00:00+00:00'),  # Wednesday
+            ('2021-06-10T01:00:00+02:00', '2021-06-03T00:00:00+00:00'),
+        ]:
+            self.assertEqual(replication.rotation_cycle_start(datetime.fromisoformat(now)),
+                             datetime.fromisoformat(start))
+
+    @override_settings(REPLICATION_ROTATION_WINDOW=20, REPLICATION_ROTATION_INTERVAL=4)
+    def test_rotate(self):
+        start = replication.rotation_cycle_start(timezone.now()) - timedelta(days=7)
+        [self.create_domain() for _ in range(20)]  # consecutive primary keys occupy all slots
+        slots = {domain.name: replication.rotation_slot(domain.pk) for domain in Domain.objects.all()}
+        self.assertEqual(set(slots.values()), set(range(20)))
+        names = sorted(slots)
+        pending = names[-1]
+        replication.schedule_update(pending)
+
+        def rotate(seconds):
+            replication.update.apply_async.reset_mock()
+            with mock.patch('desecapi.replication.timezone.now', return_value=start + timedelta(seconds=seconds)):
+                with self.assertNumQueries(1):
+                    replication.rotate()
+            return sorted(args[0][0] for args, _ in replication.update.apply_async.call_args_list)
+
+        # first run with unknown progress: the last interval
+        self.assertEqual(rotate(10), sorted(name for name, slot in slots.items()
+                                            if 6 <= slot < 10 and name != pending))
+        self.assertEqual(rotate(15), sorted(name for name, slot in slots.items()
+                                            if 10 <= slot < 15 and name != pending))
+        self.assertEqual(rotate(50), sorted(name for name, slot in slots.items()
+                                            if 15 <= slot and name != pending))
+        self.assertEqual(rotate(60), [])
+
+        # next cycle
+        rotated = rotate(7 * 24 * 3600 + 40)
+        self.assertEqual(rotated, sorted(name for name in names if name != pending))
+        replication.update.apply_async.assert_any_call(
+            (rotated[0],), {'rotation': (start + timedelta(days=7, seconds=40)).timestamp()}, priority=1)
+
+    def test_update_rotation_skipped(self):
+        domain = self.create_domain(replicated=timezone.now())
+        with mock.patch('desecapi.replication.ZoneRepository') as repository:
+            replication.update(domain.name, rotation=(timezone.now() - timedelta(seconds=1)).timestamp())
+            repository.assert_not_called()
+            repository.return_value.add_pending.return_value = 1
+            with mock.patch('desecapi.replication.commit.apply_async'):
+                replication.update(domain.name, rotation=(timezone.now() + timedelta(seconds=1)).timestamp())
+            repository.return_value.refresh.assert_called_once_with(domain.name)
+
+    @override_settings(METRICS_REPLICATION_LAG_ZONES=1)
+    def test_pending_metrics(self):
+        now = timezone.now()
+        Domain.objects.update(published=None)
+        a = self.create_domain(published=now - timedelta(seconds=60))
+        self.create_domain(published=now - timedelta(seconds=30), replicated=now - timedelta(seconds=40))
+        self.create_domain(published=now - timedelta(seconds=30), replicated=now - timedelta(seconds=20))
+        self.create_domain()
+
+        metrics = {metric.name: metric for metric in ReplicationCollector().collect()}
+        self.assertEqual(metrics['desecapi_replication_pending'].samples[0].value, 2)
+        self.assertAlmostEqual(metrics['desecapi_replication_pending_age'].samples[0].value, 60, delta=5)
+        self.assertEqual([sample.labels for sample in metrics['desecapi_replication_lag'].samples], [{'zone': a.name}])
+        self.assertEqual(metrics['desecapi_replication_rotation_progress'].samples[0].value,
+                         2 / Domain.objects.count())
+
+        # cached for the scrape interval
+        self.create_domain(published=now)
+        metrics = {metric.name: metric for metric in ReplicationCollector().collect()}
+        self.assertEqual(metrics['desecapi_replication_pending'].samples[0].value, 2)
+        cache.delete(ReplicationCollector.CACHE_KEY)
+        metrics = {metric.name: metric for metric in ReplicationCollector().collect()}
+        self.assertEqual(metrics['desecapi_replication_pending'].samples[0].value, 3)
+
+        response = self.client.get('/metrics')
+        self.assertStatus(response, status.HTTP_200_OK)
+        self.assertIn(b'desecapi_replication_pending 3.0', response.content)
+        self.assertIn(b'desecapi_replication_stage_duration', response.content)
+
 
 class RepositoryTest(testcases.TestCase):
 
@@ -117,6 +401,27 @@ class RepositoryTest(testcases.TestCase):
             repo.commit_all('commit2')
             self.assertHead(repo, message='commit2')
 
+    def test_lock(self):
+        with TemporaryDirectory() as path:
+            repo = Repository(path)
+            repo.init()
+            with open(os.path.join(path, 'test_lock'), 'w') as f:
+                f.write('foo')
+
+            committed = threading.Event()
+
+            def commit():
+                repo.commit_all('locked')
+                committed.set()
+
+            thread = threading.Thread(target=commit)
+            with repo.lock():
+                thread.start()
+                self.assertFalse(committed.wait(.5))
+            thread.join()
+            self.assertHead(repo, message='locked')
+
+    @override_settings(ZONE_REPOSITORY_PRUNE_GRACE=0)
     def test_remove_history(self):
         with TemporaryDirectory() as path:
             repo = Repository(path)
@@ -134,3 +439,340 @@ class RepositoryTest(testcases.TestCase):
 
             self.assertHasCommits(repo, keep)
             self.assertHasNotCommits(repo, remove)
+
+    def test_remove_history_grace(self):
+        with TemporaryDirectory() as path:
+            repo = Repository(path)
+            repo.init()
+            remove = self._random_commits(2, repo)
+            cutoff = datetime.now()
+            time.sleep(1)
+            keep = self._random_commits(2, repo)
+
+            self.assertIsNotNone(repo.remove_history(before=cutoff))
+            self.assertHasCommits(repo, remove + keep)  # unreachable, but still within the grace period
+            with repo.lock():  # cutting off history waits for commits, repacking does not
+                with open(os.path.join(path, '.git', 'remove-history.lock')) as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    self.assertIsNone(repo.remove_history(before=cutoff))
+
+
+    @override_settings(ZONE_REPOSITORY_REPACK_CHECKPOINTS=3)
+    def test_fast_import_repack(self):
+        def objects():  # small fast-import packs are written as loose objects
+            directories = os.listdir(os.path.join(path, '.git', 'objects'))
+            loose = sum(len(os.listdir(os.path.join(path, '.git', 'objects', d))) for d in directories if len(d) == 2)
+            packs = [f for f in os.listdir(os.path.join(path, '.git', 'objects', 'pack')) if f.endswith('.pack')]
+            return loose, len(packs)
+
+        with TemporaryDirectory() as path:
+            repo = Repository(path, GIT_BACKENDS['fast-import'])
+            repo.init()
+            try:
+                commits = []
+                for i in range(4):
+                    with open(os.path.join(path, f'file{i}'), 'w') as f:
+                        f.write(self._random_string(500))
+                    repo.commit([f'file{i}'], f'commit{i}')
+                    commits.append(repo.get_head()[0])
+                    if i == 2:
+                        self.assertEqual(objects(), (0, 1))  # merged after the third checkpoint
+                    else:
+                        self.assertNotEqual(objects()[0], 0)
+            finally:
+                repo.backend.close()
+            self.assertHasCommits(repo, commits)
+            self.assertHead(repo, message='commit3')
+
+@mock.patch('desecapi.replication.update_all')
+class ZoneRepositoryTest(testcases.TestCase):
+    name = 'example.test'
+
+    @staticmethod
+    def soa(serial):
+        return dns.rrset.from_text(dns.name.empty, 300, 'IN', 'SOA', f'ns1.example. admin.example. {serial} 1 1 1 1')
+
+    @staticmethod
+    def a(name, address):
+        return dns.rrset.from_text(dns.name.from_text(name, None), 300, 'IN', 'A', address)
+
+    def xfr(self, *rrsets, rcode=dns.rcode.NOERROR):
+        """
+        Returns a replacement for dns.query.xfr, responding with the given RRsets (relativized, one RR per RRset).
+        """
+        def _xfr(where, zone, rdtype=dns.rdatatype.AXFR, **kwargs):
+            message = dns.message.make_response(dns.message.make_query(zone, rdtype))
+            message.set_rcode(rcode)
+            if rcode != dns.rcode.NOERROR:
+                raise dns.query.TransferError(rcode)
+            message.answer = [rrset.copy() for rrset in rrsets]
+            self.transfers.append(dns.rdatatype.to_text(rdtype))
+            yield message
+        return _xfr
+
+    def setUp(self):
+        super().setUp()
+        self.transfers = []
+
+    def read(self, repo):
+        return dns.zone.from_file(os.path.join(repo.path, repo.zone_path(self.name)), origin=self.name,
+                                  check_origin=False)
+
+    def refresh(self, repo, *xfrs):
+        xfrs = iter(xfrs)
+        with mock.patch('dns.query.xfr', side_effect=lambda *args, **kwargs: next(xfrs)(*args, **kwargs)):
+            return repo.refresh(self.name)
+
+    def test_axfr_then_ixfr(self, _):
+        with TemporaryDirectory() as path:
+            repo = ZoneRepository(path)
+
+            # no zone file yet: AXFR
+            self.refresh(repo, self.xfr(self.soa(1), self.a('a', '1.1.1.1'), self.a('b', '2.2.2.2'), self.soa(1)))
+            self.assertEqual(self.transfers, ['AXFR'])
+            zone = self.read(repo)
+            self.assertEqual(zone.get_rdataset('a', 'A').to_text(), '300 IN A 1.1.1.1')
+
+            # up to date
+            mtime = os.stat(os.path.join(path, self.name + '.zone')).st_mtime_ns
+            self.refresh(repo, self.xfr(self.soa(1)))
+            self.assertEqual(self.transfers, ['AXFR', 'IXFR'])
+            self.assertEqual(os.stat(os.path.join(path, self.name + '.zone')).st_mtime_ns, mtime)
+
+            # incremental: a changes, b stays
+            self.refresh(repo, self.xfr(
+                self.soa(2),
+                self.soa(1), self.a('a', '1.1.1.1'),
+                self.soa(2), self.a('a', '3.3.3.3'),
+                self.soa(2),
+            ))
+            self.assertEqual(self.transfers, ['AXFR', 'IXFR', 'IXFR'])
+            zone = self.read(repo)
+            self.assertEqual(zone.get_rdataset('@', 'SOA')[0].serial, 2)
+            self.assertEqual(zone.get_rdataset('a', 'A').to_text(), '300 IN A 3.3.3.3')
+            self.assertEqual(zone.get_rdataset('b', 'A').to_text(), '300 IN A 2.2.2.2')
+
+            # source answers IXFR with full zone
+            self.refresh(repo, self.xfr(self.soa(3), self.a('c', '4.4.4.4'), self.soa(3)))
+            zone = self.read(repo)
+            self.assertIsNone(zone.get_rdataset('a', 'A'))
+            self.assertEqual(zone.get_rdataset('c', 'A').to_text(), '300 IN A 4.4.4.4')
+
+    def test_zone_lock_slots(self, _):
+        with TemporaryDirectory() as path:
+            repo = ZoneRepository(path)
+            for i in range(1000):
+                with repo.zone_lock(f'{i}.example.test'):
+                    pass
+            slots = os.listdir(os.path.join(path, '.git', 'zone-locks'))
+            self.assertLessEqual(len(slots), 256)
+            self.assertTrue(all(len(slot) == 2 for slot in slots))
+
+    def test_transfer_records(self, _):
+        def sample():
+            return REGISTRY.get_sample_value('desecapi_replication_transfer_records_total', {'kind': 'axfr'}) or 0
+
+        with TemporaryDirectory() as path:
+            repo = ZoneRepository(path)
+            records = sample()
+            a = dns.rrset.from_text(dns.name.from_text('a', None), 300, 'IN', 'A', '1.1.1.1', '2.2.2.2', '3.3.3.3')
+            self.refresh(repo, self.xfr(self.soa(1), a, self.soa(1)))
+            self.assertEqual(sample(), records + 5)  # records, not RRsets
+
+    def test_ixfr_fallback(self, _):
+        with TemporaryDirectory() as path:
+            repo = ZoneRepository(path)
+            self.refresh(repo, self.xfr(self.soa(5), self.a('a', '1.1.1.1'), self.soa(5)))
+
+            # IXFR refused
+            self.refresh(repo, self.xfr(rcode=dns.rcode.REFUSED),
+                         self.xfr(self.soa(6), self.a('a', '2.2.2.2'), self.soa(6)))
+            self.assertEqual(self.transfers, ['AXFR', 'AXFR'])  # the refused IXFR did not yield
+            self.assertEqual(self.read(repo).get_rdataset('a', 'A').to_text(), '300 IN A 2.2.2.2')
+
+            # serial went backwards (e.g. zone was recreated)
+            self.refresh(repo, self.xfr(self.soa(1)), self.xfr(self.soa(1), self.a('b', '3.3.3.3'), self.soa(1)))
+            zone = self.read(repo)
+            self.assertEqual(zone.get_rdataset('@', 'SOA')[0].serial, 1)
+            self.assertIsNone(zone.get_rdataset('a', 'A'))
+
+    def test_zone_unchanged(self, _):
+        with TemporaryDirectory() as path:
+            repo = ZoneRepository(path)
+            filename = os.path.join(path, self.name + '.zone')
+            rrsets = [self.soa(1), self.a('a', '1.1.1.1'), self.soa(1)]
+            self.assertTrue(self.refresh(repo, self.xfr(*rrsets)))
+            mtime = os.stat(filename).st_mtime_ns
+
+            # full zone with the same content, e.g. when the source answers IXFR with the full zone
+            self.assertFalse(self.refresh(repo, self.xfr(*rrsets)))
+            self.assertEqual(os.stat(filename).st_mtime_ns, mtime)
+            self.assertEqual(os.listdir(os.path.join(path, '.git', 'zone-hashes')), [self.name])
+            self.assertFalse(os.path.exists(os.path.join(path, '.git', self.name + '.zone~')))
+
+            # without stored hash, the zone file is rewritten
+            os.remove(os.path.join(path, '.git', 'zone-hashes', self.name))
+            self.assertTrue(self.refresh(repo, self.xfr(*rrsets)))
+            self.assertTrue(self.refresh(repo, self.xfr(self.soa(2), self.a('a', '1.1.1.1'), self.soa(2))))
+
+    def test_zone_deleted(self, _):
+        with TemporaryDirectory() as path:
+            repo = ZoneRepository(path)
+            self.refresh(repo, self.xfr(self.soa(5), self.a('a', '1.1.1.1'), self.soa(5)))
+            self.assertTrue(self.refresh(repo, self.xfr(rcode=dns.rcode.NOTAUTH)))
+            self.assertFalse(os.path.exists(os.path.join(path, self.name + '.zone')))
+            self.assertFalse(os.path.exists(os.path.join(path, '.git', 'zone-hashes', self.name)))
+
+    @override_settings(ZONE_REPOSITORY_LAYOUT='hash')
+    def test_hash_layout(self, _):
+        for backend in GIT_BACKENDS.values():
+            with self.subTest(backend=backend.__name__), TemporaryDirectory() as path:
+                repo = ZoneRepository(path, backend)
+                try:
+                    self._test_hash_layout(repo)
+                finally:
+                    repo.backend.close()
+
+    def _test_hash_layout(self, repo):
+        def committed_files():
+            return repo._git_do('ls-tree', '-r', '--name-only', 'HEAD').split()
+
+        names = ['a.test', 'b.test']
+        paths = [os.path.join(hashlib.sha256(name.encode()).hexdigest()[:2], name + '.zone') for name in names]
+        self.assertEqual(repo.layout, 'hash')
+        for name in names:
+            self.name = name
+            self.refresh(repo, self.xfr(self.soa(1), self.a('a', '1.1.1.1'), self.soa(1)))
+            repo.add_pending(name)
+        repo.commit_pending()
+        self.assertEqual(committed_files(), sorted(paths))
+
+        # the serial is read from the hashed path
+        self.transfers = []
+        self.refresh(repo, self.xfr(self.soa(1)))
+        self.assertEqual(self.transfers, ['IXFR'])
+
+        # layout survives reopening, and migration moves all files
+        repo = ZoneRepository(repo.path, repo.backend.__class__)
+        self.assertEqual(repo.layout, 'hash')
+        self.assertEqual(repo.migrate_layout('flat'), 2)
+        self.assertEqual(ZoneRepository(repo.path).layout, 'flat')
+        self.assertEqual(committed_files(), ['a.test.zone', 'b.test.zone'])
+        self.assertEqual(sorted(os.listdir(repo.path)), ['.git', 'a.test.zone', 'b.test.zone'])  # no empty dirs
+
+        # deletion
+        self.assertTrue(self.refresh(repo, self.xfr(rcode=dns.rcode.NOTAUTH)))
+        self.assertFalse(os.path.exists(os.path.join(repo.path, 'b.test.zone')))
+
+    def test_zone_file_canonical(self, _):
+        with TemporaryDirectory() as path:
+            repo = ZoneRepository(path)
+            mx = dns.rrset.from_text(dns.name.empty, 300, 'IN', 'MX', '20 mx2.example.', '10 mx1.example.')
+            self.refresh(repo, self.xfr(self.soa(1), self.a('b', '2.2.2.2'), self.a('a.b', '3.3.3.3'), mx,
+                                        self.a('a', '1.1.1.1'), self.soa(1)))
+            with open(os.path.join(path, self.name + '.zone')) as f:
+                self.assertEqual(f.read().splitlines(), [
+                    '@ 300 IN SOA ns1.example. admin.example. 1 1 1 1 1',
+                    '@ 300 IN MX 10 mx1.example.',
+                    '@ 300 IN MX 20 mx2.example.',
+                    'a 300 IN A 1.1.1.1',
+                    'b 300 IN A 2.2.2.2',
+                    'a.b 300 IN A 3.3.3.3',
+                ])
+
+    def test_stage_metrics(self, _):
+        def sample(name, **labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        counts = {stage: sample('desecapi_replication_stage_duration_count', stage=stage)
+                  for stage in ['transfer', 'write', 'commit']}
+        written = sample('desecapi_replication_written_bytes_total')
+        with TemporaryDirectory() as path:
+            repo = ZoneRepository(path)
+            self.refresh(repo, self.xfr(self.soa(1), self.a('a', '1.1.1.1'), self.soa(1)))
+            repo.add_pending(self.name)
+            repo.commit_pending()
+            size = os.path.getsize(os.path.join(path, self.name + '.zone'))
+        for stage, count in counts.items():
+            self.assertEqual(sample('desecapi_replication_stage_duration_count', stage=stage), count + 1)
+        self.assertEqual(sample('desecapi_replication_written_bytes_total'), written + size)
+
+    def test_zone_file_chunked(self, _):
+        rrsets = [self.soa(1)] + [self.a(f'{i}.{j}', f'1.1.{i}.{j}') for i in range(10) for j in range(10)]
+        rrsets += [self.a('0.0', '1.1.0.0'), self.soa(1)]  # duplicate
+        zone_files = []
+        for chunk_size in [ZoneFileWriter.CHUNK_SIZE, 7]:
+            with TemporaryDirectory() as path, mock.patch.object(ZoneFileWriter, 'CHUNK_SIZE', chunk_size):
+                repo = ZoneRepository(path)
+                self.refresh(repo, self.xfr(*rrsets))
+                with open(os.path.join(path, self.name + '.zone')) as f:
+                    zone_files.append(f.read())
+                # unchanged content is recognized by its hash, without writing the zone file again
+                with mock.patch.object(ZoneFileWriter, 'write') as write:
+                    self.assertFalse(self.refresh(repo, self.xfr(*rrsets)))
+                write.assert_not_called()
+        self.assertEqual(zone_files[0], zone_files[1])
+        self.assertEqual(len(zone_files[0].splitlines()), 101)
+
+    def test_legacy_zone_file(self, _):
+        with TemporaryDirectory() as path:
+            repo = ZoneRepository(path)
+            with open(os.path.join(path, self.name + '.zone'), 'w') as f:
+                f.write('; Generated by deSEC at 2021-01-01 00:00:00Z\n'
+                        'a 300 IN A 1.1.1.1\n'
+                        '@ 300 IN SOA ns1.example. admin.example. 1 1 1 1 1\n')
+            self.refresh(repo, self.xfr(self.soa(2), self.a('b', '2.2.2.2'), self.soa(2)))
+            self.assertEqual(self.transfers, ['AXFR'])
+            with open(os.path.join(path, self.name + '.zone')) as f:
+                self.assertEqual(f.read().splitlines()[0], '@ 300 IN SOA ns1.example. admin.example. 2 1 1 1 1')
+
+    def test_commit_pending(self, _):
+        for backend in GIT_BACKENDS.values():
+            with self.subTest(backend=backend.__name__), TemporaryDirectory() as path:
+                repo = ZoneRepository(path, backend)
+                try:
+                    self._test_commit_pending(repo)
+                finally:
+                    repo.backend.close()
+
+    def _test_commit_pending(self, repo):
+        def committed_files():
+            return repo._git_do('ls-tree', '--name-only', 'HEAD').split()
+
+        head = repo.get_head()
+        for name in ['b.test', 'a.test', 'b.test']:
+            self.name = name
+            self.refresh(repo, self.xfr(self.soa(1), self.a('a', '1.1.1.1'), self.soa(1)))
+            repo.add_pending(name)
+        with open(os.path.join(repo.path, 'untracked'), 'w') as f:
+            f.write('foo')
+        self.assertEqual(repo.get_head(), head)
+
+        self.assertTrue(repo.is_pending('a.test'))
+        self.assertEqual(repo.commit_pending(), ['a.test', 'b.test'])
+        self.assertFalse(repo.is_pending('a.test'))
+        self.assertEqual(repo.get_head()[1], 'Update for 2 zones')
+        self.assertEqual(repo._git_do('show', '--format=%b', '-s').strip(), 'a.test\nb.test')
+        self.assertEqual(committed_files(), ['a.test.zone', 'b.test.zone'])
+
+        # nothing pending, or nothing changed
+        head = repo.get_head()
+        self.assertEqual(repo.commit_pending(), [])
+        repo.add_pending(self.name)
+        repo.commit_pending()
+        self.assertEqual(repo.get_head(), head)
+
+        # changed zone
+        self.refresh(repo, self.xfr(self.soa(2), self.a('a', '2.2.2.2'), self.soa(2)))
+        repo.add_pending(self.name)
+        repo.commit_pending()
+        self.assertEqual(repo.get_head()[1], 'Update for b.test')
+        self.assertIn('+a 300 IN A 2.2.2.2', repo._git_do('show', '--format=', 'HEAD'))
+
+        # deleted zone, and zone that never made it into the repository
+        self.refresh(repo, self.xfr(rcode=dns.rcode.NOTAUTH))
+        repo.add_pending(self.name)
+        repo.add_pending('c.test')
+        self.assertEqual(repo.commit_pending(), ['b.test', 'c.test'])
+        self.assertEqual(repo.get_head()[1], 'Update for 2 zones')
+        self.assertEqual(committed_files(), ['a.test.zone'])
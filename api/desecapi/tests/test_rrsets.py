@@ -6,9 +6,11 @@ from math import ceil, floor
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.management import call_command
+from django.test import override_settings, TestCase
+from prometheus_client import REGISTRY
 from rest_framework import status
 
-from desecapi.models import Domain, RRset, RR_SET_TYPES_AUTOMATIC, RR_SET_TYPES_UNSUPPORTED
+from desecapi.models import Domain, RR, RRset, RR_SET_TYPES_AUTOMATIC, RR_SET_TYPES_UNSUPPORTED
 from desecapi.tests.base import DesecTestCase, AuthenticatedRRSetBaseTestCase
 
 
@@ -919,3 +921,33 @@ class AuthenticatedRRSetTestCase(AuthenticatedRRSetBaseTestCase):
             self.assertStatus(response, status.HTTP_200_OK)
             self.assertEqual(len(response.data), 1, response.data)
             self.assertContainsRRSets(response.data, [dict(subname='', records=settings.DEFAULT_NS, type='NS')])
+
+
+class CanonicalPresentationFormatTestCase(TestCase):
+
+    @staticmethod
+    def sample(name):
+        return REGISTRY.get_sample_value(name) or 0
+
+    def test_cached(self):
+        RR._canonical_presentation_format_cached.cache_clear()
+        calls = self.sample('desecapi_rr_canonical_format_calls_total')
+        parses = self.sample('desecapi_rr_canonical_format_parse_duration_count')
+        for _ in range(3):
+            self.assertEqual(RR.canonical_presentation_format('2001:db8::0001', 'AAAA'), '2001:db8::1')
+            self.assertEqual(RR.canonical_presentation_format('010 example.com.', 'MX'), '10 example.com.')
+        self.assertEqual(self.sample('desecapi_rr_canonical_format_calls_total'), calls + 6)
+        self.assertEqual(self.sample('desecapi_rr_canonical_format_parse_duration_count'), parses + 2)
+
+        # errors are not cached
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                RR.canonical_presentation_format('127.0.0.999', 'A')
+        self.assertEqual(self.sample('desecapi_rr_canonical_format_parse_duration_count'), parses + 4)
+
+    @override_settings(RR_CANONICAL_FORMAT_CACHE_MAX_LENGTH=8)
+    def test_long_records_not_cached(self):
+        RR._canonical_presentation_format_cached.cache_clear()
+        for _ in range(2):
+            self.assertEqual(RR.canonical_presentation_format('2001:db8::0001', 'AAAA'), '2001:db8::1')
+        self.assertEqual(RR._canonical_presentation_format_cached.cache_info().currsize, 0)
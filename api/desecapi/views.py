@@ -1,16 +1,20 @@
 import base64
 import binascii
+import json
 from datetime import timedelta
 from functools import cached_property
+from hashlib import sha256
 
 from django.conf import settings
 from django.contrib.auth import user_logged_in
 from django.contrib.auth.hashers import is_password_usable
 from django.core.cache import cache
 from django.core.mail import EmailMessage
+from django.db.models import Max, Min
 from django.http import Http404
 from django.shortcuts import redirect
 from django.template.loader import get_template
+from django.utils import timezone
 from rest_framework import generics, mixins, status, viewsets
 from rest_framework.authentication import get_authorization_header
 from rest_framework.exceptions import (NotAcceptable, NotFound, PermissionDenied, ValidationError)
@@ -24,7 +28,7 @@ from rest_framework.views import APIView
 import desecapi.authentication as auth
 from desecapi import metrics, models, serializers
 from desecapi.exceptions import ConcurrencyException
-from desecapi.pdns import get_serials
+from desecapi.pdns import get_serial, get_serials
 from desecapi.pdns_change_tracker import PDNSChangeTracker
 from desecapi.permissions import ManageTokensPermission, IsDomainOwner, IsOwner, IsVPNClient, WithinDomainLimitOnPOST
 from desecapi.renderers import PlainTextRenderer
@@ -173,13 +177,97 @@ class SerialListView(APIView):
     permission_classes = (IsVPNClient,)
     throttle_classes = []  # don't break slaves when they ask too often (our cached responses are cheap)
 
-    def get(self, request, *args, **kwargs):
+    @staticmethod
+    def get_full_serials():
+        """
+        Returns the serials of all zones on nsmaster, along with their ETag (computed once per fetched list).
+        """
         key = 'desecapi.views.serials'
-        serials = cache.get(key)
-        if serials is None:
+        cached = cache.get(key)
+        if cached is None:
             serials = get_serials()
-            cache.get_or_set(key, serials, timeout=15)
-        return Response(serials)
+            etag = '"%s"' % sha256(json.dumps(serials, sort_keys=True).encode()).hexdigest()[:32]
+            cached = cache.get_or_set(key, (serials, etag), timeout=15)
+            SerialListView.record_untracked_changes(serials)
+        return cached
+
+    @staticmethod
+    def record_untracked_changes(serials):
+        """
+        Records zones whose serial changed without going through the change tracker (e.g. weekly serial increments on
+        nslord, sync-to-pdns), by comparing with the serials fetched last time, so that deltas include them. This
+        happens whenever the full list is fetched from nsmaster (which delta requests never do).
+        """
+        key = 'desecapi.views.serials.previous'
+        previous = cache.get(key)
+        cache.set(key, serials, timeout=None)
+        if previous is None:
+            return
+        names = {name for name in previous.keys() | serials.keys() if previous.get(name) != serials.get(name)}
+        models.ZoneChange.objects.bulk_create([models.ZoneChange(name=name.rstrip('.')) for name in names])
+
+    @staticmethod
+    def get_changed_serials(names):
+        """
+        Returns the serials of the given zones, taken from the full list if it is cached, and looked up individually on
+        nsmaster otherwise. Returns None if that would take more than settings.SERIALS_DELTA_LOOKUP_LIMIT lookups.
+        """
+        cached = cache.get('desecapi.views.serials')
+        if cached is not None:
+            return {f'{name}.': cached[0].get(f'{name}.') for name in names}
+
+        keys = {f'desecapi.views.serials.{name}': name for name in names}
+        serials = {f'{keys[key]}.': serial for key, serial in cache.get_many(keys.keys()).items()}
+        missing = [name for name in names if f'{name}.' not in serials]
+        if len(missing) > settings.SERIALS_DELTA_LOOKUP_LIMIT:
+            return None
+        fetched = {name: get_serial(name) for name in missing}
+        cache.set_many({f'desecapi.views.serials.{name}': serial for name, serial in fetched.items()}, timeout=15)
+        serials.update({f'{name}.': serial for name, serial in fetched.items()})
+        return serials
+
+    @staticmethod
+    def get_cursor(since):
+        """
+        Returns (cursor, latest), where cursor is the position up to which all changes have settled on nsmaster, and
+        latest is the position of the most recent change. Changes between the two are reported again next time.
+        """
+        changes = models.ZoneChange.objects.filter(id__gt=since)
+        latest = changes.aggregate(Max('id'))['id__max'] or since
+        unsettled = changes.filter(created__gt=timezone.now() - settings.SERIALS_CHANGE_SETTLE_PERIOD)
+        cursor = (unsettled.aggregate(Min('id'))['id__min'] or latest + 1) - 1
+        return cursor, latest
+
+    def get(self, request, *args, **kwargs):
+        since = request.query_params.get('since')
+        if since is not None:
+            try:
+                since = int(since)
+                if since < 0:
+                    raise ValueError
+            except ValueError:
+                raise ValidationError({'since': ['Cursor must be a non-negative integer.']})
+            oldest = models.ZoneChange.objects.aggregate(Min('id'))['id__min']
+            if oldest is not None and since < oldest - 1:
+                return Response({'detail': 'Cursor has expired. Please retrieve the full serial list.'},
+                                status=status.HTTP_410_GONE)
+
+        if since is None:
+            serials, etag = self.get_full_serials()  # first, so that untracked changes are recorded before the cursor
+            cursor, latest = self.get_cursor(0)
+        else:
+            cursor, latest = self.get_cursor(since)
+            names = models.ZoneChange.objects.filter(id__gt=since, id__lte=latest).values_list('name', flat=True)
+            serials = self.get_changed_serials(set(names))
+            if serials is None:
+                return Response({'detail': 'Too many changes since cursor. Please retrieve the full serial list.'},
+                                status=status.HTTP_410_GONE)
+            etag = '"%s"' % sha256(json.dumps([cursor, serials], sort_keys=True).encode()).hexdigest()[:32]
+
+        headers = {'ETag': etag, 'X-Serials-Cursor': str(cursor)}
+        if etag in (tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(serials, headers=headers)
 
 
 class RRsetDetail(IdempotentDestroyMixin, DomainViewMixin, generics.RetrieveUpdateDestroyAPIView):
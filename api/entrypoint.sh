@@ -19,5 +19,8 @@ python manage.py migrate || exit 1
 # Prepare catalog zone
 python manage.py align-catalog-zone
 
+# Fetch PSL snapshot, if configured (in the background, lookups use the PSL resolver meanwhile)
+( python manage.py update-psl-snapshot & )
+
 echo Starting API server ...
 exec uwsgi --ini uwsgi.ini